@@ -12,6 +12,9 @@ import institutions_service
 from __init__ import _
 
 
+XLINK_HREF = '{http://www.w3.org/1999/xlink}href'
+INDEXED_ATTRIBUTES = ['id', XLINK_HREF]
+
 IMG_EXTENSIONS = ['.tif', '.tiff', '.eps', '.gif', '.png', '.jpg', ]
 REQUIRES_PERMISSIONS = [
         'boxed-text', 
@@ -179,6 +182,72 @@ class Text(object):
         self.language = ''
 
 
+class ElementsIndex(object):
+    """
+    Elements of the tree (except the root), in document order, indexed by
+    tag, by the tags of their children and by INDEXED_ATTRIBUTES
+    All of them are found in one traversal of the tree
+    """
+
+    def __init__(self, tree):
+        self.by_tag = {}
+        self.by_child_tag = {}
+        self.by_attribute = {name: [] for name in INDEXED_ATTRIBUTES}
+        self.parent = {}
+        root = tree.getroot() if hasattr(tree, 'getroot') else tree
+        for elem in root.iter():
+            if elem is not root:
+                self.by_tag.setdefault(elem.tag, []).append(elem)
+                for name in INDEXED_ATTRIBUTES:
+                    if name in elem.attrib:
+                        self.by_attribute[name].append(elem)
+            child_tags = set()
+            for child in elem:
+                self.parent[child] = elem
+                if elem is not root and not child.tag in child_tags:
+                    child_tags.add(child.tag)
+                    self.by_child_tag.setdefault(child.tag, []).append(elem)
+
+    def elements(self, tag, attribute=None, value=None):
+        """
+        Same as findall('.//tag'), or findall('.//tag[@attribute="value"]')
+        """
+        items = self.by_tag.get(tag, [])
+        if attribute is not None:
+            return [elem for elem in items if elem.attrib.get(attribute) == value]
+        return list(items)
+
+    def find(self, tag, attribute=None, value=None):
+        items = self.elements(tag, attribute, value)
+        return items[0] if len(items) > 0 else None
+
+    def elements_which_have_child(self, child_tag):
+        """
+        Same as findall('.//*[child_tag]')
+        """
+        return list(self.by_child_tag.get(child_tag, []))
+
+    def elements_which_have_attribute(self, attribute):
+        """
+        Same as findall('.//*[@attribute]'), attribute in INDEXED_ATTRIBUTES
+        """
+        return list(self.by_attribute[attribute])
+
+    def parents(self, elements):
+        """
+        Same as findall('<elements xpath>/..'): the parents, in the order of
+        their first child in elements
+        """
+        items = []
+        found = set()
+        for elem in elements:
+            parent = self.parent.get(elem)
+            if parent is not None and not parent in found:
+                found.add(parent)
+                items.append(parent)
+        return items
+
+
 class ArticleXML(object):
 
     def __init__(self, tree):
@@ -208,6 +277,12 @@ class ArticleXML(object):
         self._any_xref_ranges = None
         self._any_xref_parent_nodes = None
         self._any_xref_nodes = None
+        self._elements_index = None
+        self._xref_nodes = None
+        self._hrefs = None
+        self._tables = None
+        self._contrib_names = None
+        self._affiliations = None
 
         if tree is not None:
             self.journal_meta = self.tree.find('./front/journal-meta')
@@ -220,13 +295,19 @@ class ArticleXML(object):
                     self.sub_articles.append(s)
             self.responses = self.tree.findall('./response')
 
+    @property
+    def elements_index(self):
+        if self._elements_index is None and self.tree is not None:
+            self._elements_index = ElementsIndex(self.tree)
+        return self._elements_index
+
     @property
     def months(self):
         items = []
-        nodes = self.tree.findall('.//pub-date[month]')
+        nodes = [node for node in self.elements_index.elements('pub-date') if node.find('month') is not None]
         for node in nodes:
             items.append((node.tag, node.attrib.get('pub-type'), node.findtext('month')))
-        nodes = self.tree.findall('.//element-citation[month]/..')
+        nodes = self.elements_index.parents([node for node in self.elements_index.elements('element-citation') if node.find('month') is not None])
         for node in nodes:
             for month_node in node.findall('.//element-citation/month'):
                 items.append((node.tag, node.attrib.get('id'), month_node.text))
@@ -235,10 +316,10 @@ class ArticleXML(object):
     @property
     def seasons(self):
         items = []
-        nodes = self.tree.findall('.//pub-date[season]')
+        nodes = [node for node in self.elements_index.elements('pub-date') if node.find('season') is not None]
         for node in nodes:
             items.append((node.tag, node.attrib.get('pub-type'), node.findtext('season')))
-        nodes = self.tree.findall('.//element-citation[season]/..')
+        nodes = self.elements_index.parents([node for node in self.elements_index.elements('element-citation') if node.find('season') is not None])
         for node in nodes:
             for season_node in node.findall('.//element-citation/season'):
                 items.append((node.tag, node.attrib.get('id'), season_node.text))
@@ -340,7 +421,7 @@ class ArticleXML(object):
         if self._any_xref_parent_nodes is None:
             self._any_xref_parent_nodes = {}
             if self.tree is not None:
-                for xref_parent_node in self.tree.findall('.//*[xref]'):
+                for xref_parent_node in self.elements_index.elements_which_have_child('xref'):
                     xref_nodes = {}
                     for xref_node in xref_parent_node.findall('xref'):
                         xref_type = xref_node.attrib.get('ref-type')
@@ -417,7 +498,7 @@ class ArticleXML(object):
         if self._bibr_xref_parent_nodes is None:
             self._bibr_xref_parent_nodes = []
             if self.tree is not None:
-                for node in self.tree.findall('.//*[xref]'):
+                for node in self.elements_index.elements_which_have_child('xref'):
                     bibr_xref = node.findall('xref[@ref-type="bibr"]')
                     if len(bibr_xref) > 0:
                         self._bibr_xref_parent_nodes.append((node, bibr_xref))
@@ -427,20 +508,21 @@ class ArticleXML(object):
     def bibr_xref_nodes(self):
         if self._bibr_xref_nodes is None:
             if self.tree is not None:
-                self._bibr_xref_nodes = self.tree.findall('.//xref[@ref-type="bibr"]')
+                self._bibr_xref_nodes = self.elements_index.elements('xref', 'ref-type', 'bibr')
         return self._bibr_xref_nodes
 
     @property
     def xref_nodes(self):
-        _xref_list = []
-        if self.tree is not None:
-            for node in self.tree.findall('.//xref'):
-                n = {}
-                n['ref-type'] = node.attrib.get('ref-type')
-                n['rid'] = node.attrib.get('rid')
-                n['xml'] = xml_utils.node_xml(node)
-                _xref_list.append(n)
-        return _xref_list
+        if self._xref_nodes is None:
+            self._xref_nodes = []
+            if self.tree is not None:
+                for node in self.elements_index.elements('xref'):
+                    n = {}
+                    n['ref-type'] = node.attrib.get('ref-type')
+                    n['rid'] = node.attrib.get('rid')
+                    n['xml'] = xml_utils.node_xml(node)
+                    self._xref_nodes.append(n)
+        return self._xref_nodes
 
     @property
     def dtd_version(self):
@@ -627,22 +709,24 @@ class ArticleXML(object):
 
     @property
     def contrib_names(self):
-        k = []
-        if self.article_meta is not None:
-            for contrib in self.article_meta.findall('.//contrib'):
-                if contrib.findall('name'):
-                    p = PersonAuthor()
-                    p.fname = contrib.findtext('name/given-names')
-                    p.surname = contrib.findtext('name/surname')
-                    p.suffix = contrib.findtext('name/suffix')
-                    p.prefix = contrib.findtext('name/prefix')
-                    for contrib_id in contrib.findall('contrib-id[@contrib-id-type]'):
-                        p.contrib_id[contrib_id.attrib.get('contrib-id-type')] = contrib_id.text
-                    p.role = contrib.attrib.get('contrib-type')
-                    for xref_item in contrib.findall('xref[@ref-type="aff"]'):
-                        p.xref.append(xref_item.attrib.get('rid'))
-                    k.append(p)
-        return k
+        if self._contrib_names is None:
+            self._contrib_names = []
+            if self.article_meta is not None:
+                for contrib in self.article_meta.findall('.//contrib'):
+                    if contrib.findall('name'):
+                        p = PersonAuthor()
+                        p.fname = contrib.findtext('name/given-names')
+                        p.surname = contrib.findtext('name/surname')
+                        p.suffix = contrib.findtext('name/suffix')
+                        p.prefix = contrib.findtext('name/prefix')
+                        for contrib_id in contrib.findall('contrib-id[@contrib-id-type]'):
+                            p.contrib_id[contrib_id.attrib.get('contrib-id-type')] = contrib_id.text
+                        p.role = contrib.attrib.get('contrib-type')
+                        for xref_item in contrib.findall('xref[@ref-type="aff"]'):
+                            p.xref.append(xref_item.attrib.get('rid'))
+                        self._contrib_names.append(p)
+        # copy: the callers may change the list
+        return list(self._contrib_names)
 
     @property
     def authors_aff_xref_stats(self):
@@ -863,12 +947,12 @@ class ArticleXML(object):
     @property
     def financial_disclosure(self):
         if self.tree is not None:
-            return xml_utils.node_text(self.tree.find('.//fn[@fn-type="financial-disclosure"]'))
+            return xml_utils.node_text(self.elements_index.find('fn', 'fn-type', 'financial-disclosure'))
 
     @property
     def fn_financial_disclosure(self):
         if self.tree is not None:
-            return xml_utils.node_xml(self.tree.find('.//fn[@fn-type="financial-disclosure"]'))
+            return xml_utils.node_xml(self.elements_index.find('fn', 'fn-type', 'financial-disclosure'))
 
     @property
     def fpage(self):
@@ -892,22 +976,24 @@ class ArticleXML(object):
 
     @property
     def affiliations(self):
-        affs = []
-        if self.article_meta is not None:
-            for aff in self.article_meta.findall('.//aff'):
-                affs.append(get_affiliation(aff))
-        if self.sub_articles is not None:
-            for sub_art in self.sub_articles:
-                for aff in sub_art.findall('.//aff'):
-                    affs.append(get_affiliation(aff))
-        return affs
+        if self._affiliations is None:
+            self._affiliations = []
+            if self.article_meta is not None:
+                for aff in self.article_meta.findall('.//aff'):
+                    self._affiliations.append(get_affiliation(aff))
+            if self.sub_articles is not None:
+                for sub_art in self.sub_articles:
+                    for aff in sub_art.findall('.//aff'):
+                        self._affiliations.append(get_affiliation(aff))
+        # copy: the callers may change the list
+        return list(self._affiliations)
 
     @property
     def uri_clinical_trial_href(self):
         #FIXME nao existe clinical-trial 
         #<uri content-type="clinical-trial" xlink:href="http://www.ensaiosclinicos.gov.br/rg/RBR-7bqxm2/">The study was registered in the Brazilian Clinical Trials Registry (RBR-7bqxm2)</uri>
         if self.tree is not None:
-            node = self.tree.find('.//uri[@content-type="clinical-trial"]')
+            node = self.elements_index.find('uri', 'content-type', 'clinical-trial')
             if node is not None:
                 return node.attrib.get('{http://www.w3.org/1999/xlink}href')
 
@@ -916,7 +1002,7 @@ class ArticleXML(object):
         #FIXME nao existe clinical-trial 
         #<uri content-type="clinical-trial" xlink:href="http://www.ensaiosclinicos.gov.br/rg/RBR-7bqxm2/">The study was registered in the Brazilian Clinical Trials Registry (RBR-7bqxm2)</uri>
         if self.tree is not None:
-            node = self.tree.find('.//uri[@content-type="clinical-trial"]')
+            node = self.elements_index.find('uri', 'content-type', 'clinical-trial')
             if node is not None:
                 return xml_utils.node_text(node)
 
@@ -925,7 +1011,7 @@ class ArticleXML(object):
         #FIXME nao existe clinical-trial 
         #<ext-link ext-link-type="clinical-trial" xlink:href="http://www.ensaiosclinicos.gov.br/rg/RBR-7bqxm2/">The study was registered in the Brazilian Clinical Trials Registry (RBR-7bqxm2)</ext-link>
         if self.tree is not None:
-            node = self.tree.find('.//ext-link[@ext-link-type="clinical-trial"]')
+            node = self.elements_index.find('ext-link', 'ext-link-type', 'clinical-trial')
             if node is not None:
                 return node.attrib.get('{http://www.w3.org/1999/xlink}href')
 
@@ -934,7 +1020,7 @@ class ArticleXML(object):
         #FIXME nao existe clinical-trial 
         #<ext-link ext-link-type="clinical-trial" xlink:href="http://www.ensaiosclinicos.gov.br/rg/RBR-7bqxm2/">The study was registered in the Brazilian Clinical Trials Registry (RBR-7bqxm2)</ext-link>
         if self.tree is not None:
-            node = self.tree.find('.//ext-link[@ext-link-type="clinical-trial"]')
+            node = self.elements_index.find('ext-link', 'ext-link-type', 'clinical-trial')
             if node is not None:
                 return xml_utils.node_text(node)
 
@@ -978,32 +1064,32 @@ class ArticleXML(object):
         if node is not None:
             return len(node.findall(xpath))
 
+    def total_of_elements(self, tag):
+        if self.tree is not None:
+            return len(self.elements_index.by_tag.get(tag, []))
+
     @property
     def total_of_references(self):
-        return self.total(self.tree, './/ref')
+        return self.total_of_elements('ref')
 
     @property
     def total_of_tables(self):
-        return self.total(self.tree, './/table-wrap')
+        return self.total_of_elements('table-wrap')
 
     @property
     def total_of_equations(self):
-        return self.total(self.tree, './/disp-formula')
+        return self.total_of_elements('disp-formula')
 
     @property
     def total_of_figures(self):
-        return self.total(self.tree, './/fig')
+        return self.total_of_elements('fig')
 
     @property
     def formulas(self):
         r = []
         if self.tree is not None:
-            if self.tree.findall('.//disp-formula') is not None:
-                for item in self.tree.findall('.//disp-formula'):
-                    r.append(xml_utils.node_xml(item))
-            if self.tree.findall('.//inline-formula') is not None:
-                for item in self.tree.findall('.//inline-formula'):
-                    r.append(xml_utils.node_xml(item))
+            for item in self.elements_index.elements('disp-formula') + self.elements_index.elements('inline-formula'):
+                r.append(xml_utils.node_xml(item))
         return r
 
     @property
@@ -1140,9 +1226,9 @@ class ArticleXML(object):
     def illustrative_materials(self):
         _illustrative_materials = []
         if self.tree is not None:
-            if len(self.tree.findall('.//table-wrap')) > 0:
+            if self.total_of_elements('table-wrap') > 0:
                 _illustrative_materials.append('TAB')
-            figs = len(self.tree.findall('.//fig'))
+            figs = self.total_of_elements('fig')
             if figs > 0:
                 _illustrative_materials.append('GRA')
 
@@ -1176,7 +1262,7 @@ class ArticleXML(object):
     def permissions_required(self):
         missing_permissions = []
         for tag in REQUIRES_PERMISSIONS:
-            for node in self.tree.findall('.//' + tag):
+            for node in self.elements_index.elements(tag):
                 missing_children = []
                 for child in ['license', 'copyright-holder', 'copyright-year', 'copyright-statement']:
                     if node.find('.//' + child) is None:
@@ -1184,7 +1270,7 @@ class ArticleXML(object):
                 if len(missing_children) > 0:
                     identif = node.tag
                     if node.attrib.get('id') is None:
-                        if self.tree.findall('.//' + tag) > 1:
+                        if len(self.elements_index.elements(tag)) > 1:
                             identif = xml_utils.node_xml(node)
                     else:
                         identif = node.tag + '(' + node.attrib.get('id', '') + ')'
@@ -1194,7 +1280,7 @@ class ArticleXML(object):
     @property
     def elements_which_has_id_attribute(self):
         if self.tree is not None:
-            return self.tree.findall('.//*[@id]')
+            return self.elements_index.elements_which_have_attribute('id')
 
     @property
     def href_files(self):
@@ -1202,30 +1288,33 @@ class ArticleXML(object):
 
     @property
     def hrefs(self):
-        r = []
-        if self.tree is not None:
-            for parent in self.tree.findall('.//*[@{http://www.w3.org/1999/xlink}href]/..'):
-                for elem in parent.findall('*[@{http://www.w3.org/1999/xlink}href]'):
-                    href = elem.attrib.get('{http://www.w3.org/1999/xlink}href')
-                    _href = HRef(href, elem, parent, xml_utils.node_xml(parent), self.prefix)
-                    r.append(_href)
-        return r
+        if self._hrefs is None:
+            self._hrefs = []
+            if self.tree is not None:
+                for parent in self.elements_index.parents(self.elements_index.elements_which_have_attribute(XLINK_HREF)):
+                    parent_xml = xml_utils.node_xml(parent)
+                    for elem in parent.findall('*[@{http://www.w3.org/1999/xlink}href]'):
+                        href = elem.attrib.get('{http://www.w3.org/1999/xlink}href')
+                        _href = HRef(href, elem, parent, parent_xml, self.prefix)
+                        self._hrefs.append(_href)
+        return self._hrefs
 
     @property
     def tables(self):
-        r = []
-        if self.tree is not None:
-            for t in self.tree.findall('.//*[table]'):
-                graphic = t.find('./graphic')
-                _href = None
-                if graphic is not None:
-                    src = graphic.attrib.get('{http://www.w3.org/1999/xlink}href')
-                    xml = xml_utils.node_xml(graphic)
-
-                    _href = HRef(src, graphic, t, xml, self.prefix)
-                _table = Table(t.tag, t.attrib.get('id'), t.findtext('.//label'), xml_utils.node_text(t.find('.//caption')), _href, xml_utils.node_xml(t.find('./table')))
-                r.append(_table)
-        return r
+        if self._tables is None:
+            self._tables = []
+            if self.tree is not None:
+                for t in self.elements_index.elements_which_have_child('table'):
+                    graphic = t.find('./graphic')
+                    _href = None
+                    if graphic is not None:
+                        src = graphic.attrib.get('{http://www.w3.org/1999/xlink}href')
+                        xml = xml_utils.node_xml(graphic)
+
+                        _href = HRef(src, graphic, t, xml, self.prefix)
+                    _table = Table(t.tag, t.attrib.get('id'), t.findtext('.//label'), xml_utils.node_text(t.find('.//caption')), _href, xml_utils.node_xml(t.find('./table')))
+                    self._tables.append(_table)
+        return self._tables
 
 
 class Article(ArticleXML):
@@ -14,6 +14,10 @@ import article as article_module
 
 URL_CHECKED = []
 
+# (orgname, norgname, country, i_country, state, city): (valid institution, found institutions)
+INSTITUTIONS_NORMALIZATION = {}
+INSTITUTIONS_NORMALIZATION_MAX_ITEMS = 20000
+
 MONTHS = {'': '00', 'Jan': '01', 'Feb': '02', 'Mar': '03', 'Apr': '04', 'May': '05', 'Jun': '06', 'Jul': '07', 'Aug': '08', 'Sep': '09', 'Oct': '10', 'Nov': '11', 'Dec': '12', }
 
 
@@ -357,19 +361,67 @@ def normalize_affiliations(article):
             article.normalized_affiliations[aff.id] = norm_aff
 
 
+def normalize_package_affiliations(articles):
+    """
+    Normalizes the affiliations of all the articles of a package,
+    resolving each distinct affiliation only once
+    """
+    affiliations = {}
+    for article in articles:
+        for aff in article.affiliations:
+            affiliations[affiliation_key(aff)] = aff
+    for key in sorted(affiliations.keys()):
+        institution_normalization(*key)
+    for article in articles:
+        normalize_affiliations(article)
+
+
+def affiliation_key(aff):
+    return (aff.orgname, aff.norgname, aff.country, aff.i_country, aff.state, aff.city)
+
+
 def normalized_institution(aff):
     norm_aff = None
+    valid, found_institutions = institution_normalization(*affiliation_key(aff))
+    if valid is not None:
+        norm_orgname, norm_city, norm_state, norm_country_code, norm_country_name = valid
+        norm_aff = article_module.Affiliation()
+        norm_aff.id = aff.id
+        norm_aff.norgname = norm_orgname
+        norm_aff.city = norm_city
+        norm_aff.state = norm_state
+        norm_aff.i_country = norm_country_code
+        norm_aff.country = norm_country_name
+    return (norm_aff, found_institutions)
+
+
+def institution_normalization(orgname, norgname, country, i_country, state, city):
+    """
+    Returns (valid institution or None, found institutions)
+    The results are kept in INSTITUTIONS_NORMALIZATION, because the same
+    affiliation is repeated in the articles of a package
+    """
+    key = (orgname, norgname, country, i_country, state, city)
+    if not key in INSTITUTIONS_NORMALIZATION:
+        if len(INSTITUTIONS_NORMALIZATION) >= INSTITUTIONS_NORMALIZATION_MAX_ITEMS:
+            INSTITUTIONS_NORMALIZATION.clear()
+        INSTITUTIONS_NORMALIZATION[key] = find_institution_normalization(orgname, norgname, country, i_country, state, city)
+    return INSTITUTIONS_NORMALIZATION[key]
+
+
+def find_institution_normalization(orgname, norgname, country, i_country, state, city):
+    normalized = None
     found_institutions = None
-    orgnames = [item.upper() for item in [aff.orgname, aff.norgname] if item is not None]
-    if aff.norgname is not None or aff.orgname is not None:
-        found_institutions = institutions_service.validate_organization(aff.orgname, aff.norgname, aff.country, aff.i_country, aff.state, aff.city)
+    orgnames = [item.upper() for item in [orgname, norgname] if item is not None]
+    if norgname is not None or orgname is not None:
+        found_institutions = institutions_service.validate_organization(orgname, norgname, country, i_country, state, city)
 
     if found_institutions is not None:
         if len(found_institutions) == 1:
             valid = found_institutions
         else:
             valid = []
-            if aff.i_country is None:
+            if i_country is None:
                 country_info = {}
                 for k, v in list(set([(norm_country_name, norm_country_code) for norm_orgname, norm_city, norm_state, norm_country_code, norm_country_name in found_institutions if norm_country_name is not None and norm_country_code is not None])):
                     if not k in country_info.keys():
@@ -384,7 +436,7 @@ def normalized_institution(aff):
                         valid.append((norm_orgname, norm_city, norm_state, norm_country_code, norm_country_name))
             else:
                 for norm_orgname, norm_city, norm_state, norm_country_code, norm_country_name in found_institutions:
-                    if norm_orgname.upper() in orgnames and aff.i_country == norm_country_code:
+                    if norm_orgname.upper() in orgnames and i_country == norm_country_code:
                         valid.append((norm_orgname, norm_city, norm_state, norm_country_code, norm_country_name))
             if len(valid) > 1:
                 country_info = list(set([(norm_country_name, norm_country_code) for norm_orgname, norm_city, norm_state, norm_country_code, norm_country_name in valid]))
@@ -395,15 +447,9 @@ def normalized_institution(aff):
             norm_orgname, norm_city, norm_state, norm_country_code, norm_country_name = valid[0]
 
             if norm_orgname is not None and norm_country_code is not None:
-                norm_aff = article_module.Affiliation()
-                norm_aff.id = aff.id
-                norm_aff.norgname = norm_orgname
-                norm_aff.city = norm_city
-                norm_aff.state = norm_state
-                norm_aff.i_country = norm_country_code
-                norm_aff.country = norm_country_name
+                normalized = valid[0]
 
-    return (norm_aff, found_institutions)
+    return (normalized, found_institutions)
 
 
 def tiff_info(img_filename):
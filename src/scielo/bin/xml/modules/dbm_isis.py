@@ -2,10 +2,14 @@
 
 
 import os
+import struct
 import sys
+import time
 from tempfile import mkdtemp, NamedTemporaryFile
 
 from article_utils import u_encode
+import dbm_isis_inv
+import dbm_isis_mst
 import xml_utils
 import utils
 import fs_utils
@@ -50,18 +54,105 @@ def format_value(content):
     return content.strip()
 
 
+SUBFIELDS = 'abcdefghijklmnopqrstuvwxyz123456789'
+TAG_PREFIXES = {}
+
+
+def tag_prefix(tag):
+    """
+    Returns '!v010!' for '10'
+    """
+    prefix = TAG_PREFIXES.get(tag)
+    if prefix is None:
+        prefix = TAG_PREFIXES[tag] = '!v' + ('000' + tag)[-3:] + '!'
+    return prefix
+
+
+ID_FILE_WHITESPACE = ' \t\n\r\x0b\x0c'
+ID_FILE_CHUNK_SIZE = 1024 * 1024
+
+
+def iter_lines(filename, encoding='iso-8859-1', chunk_size=ID_FILE_CHUNK_SIZE):
+    """
+    Yields the decoded lines of filename, which is read by chunks
+    """
+    remainder = u''
+    with open(filename, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            lines = (remainder + chunk.decode(encoding)).split(u'\n')
+            remainder = lines.pop()
+            for line in lines:
+                yield line
+    if remainder != u'':
+        yield remainder
+
+
+def subfields(content):
+    """
+    Returns content, if it has no subfield, otherwise a tuple of
+    (subfield, value). The text which is before the first subfield is
+    identified by '_'
+    """
+    if not u'^' in content:
+        return content
+    parts = content.split(u'^')
+    items = [('_', parts[0])]
+    for part in parts[1:]:
+        if part != u'':
+            items.append((part[0], part[1:]))
+    return tuple(items)
+
+
+class IDRecord(object):
+    """
+    Compact record: tuple of (tag, content), in the original order
+    content is a string or a tuple of (subfield, value)
+    """
+
+    __slots__ = ('fields', )
+
+    def __init__(self, fields):
+        self.fields = tuple(fields)
+
+    def to_dict(self):
+        """
+        Returns {tag: content} or {tag: [content, ...]} (repeated tags)
+        content is a string or {subfield: value}
+        """
+        record = {}
+        for tag, content in self.fields:
+            if isinstance(content, tuple):
+                content = dict(content)
+            if tag in record:
+                record[tag].append(content)
+            else:
+                record[tag] = [content]
+        for tag, content in record.iteritems():
+            record[tag] = content[0] if len(content) == 1 else content
+        return record
+
+
 class IDFile(object):
 
     def __init__(self, content_formatter=None):
         self.content_formatter = content_formatter
 
     def _format_file(self, records):
-        r = []
+        """
+        Yields the records formatted and encoded, one by one
+        """
         index = 0
         for item in records:
             index += 1
-            r.append(self._format_id(index) + self._format_record(item))
-        return ''.join(r)
+            content = self._format_id(index) + self._format_record(item)
+            if isinstance(content, unicode):
+                content = u_encode(content, 'iso-8859-1')
+                if '<PRESERVECIRC/>' in content:
+                    content = content.replace('<PRESERVECIRC/>', '&#94;')
+            yield content
 
     def _format_id(self, index):
         i = '000000' + str(index)
@@ -97,7 +188,7 @@ class IDFile(object):
             utils.debbuging(data)
             s = ''
         elif isinstance(data, dict):
-            s = self.tag_content(tag, self.format_subfields(data))
+            s = self.tag_content(tag, self.format_subfields(data), True)
         else:
             s = self.tag_content(tag, data)
         return s
@@ -105,35 +196,38 @@ class IDFile(object):
     def format_subfields(self, subf_and_value_list):
         try:
             first = u''
-            value = u''
+            value = []
             #for k, v in subf_and_value_list.items():
             for k in sorted(subf_and_value_list.keys()):
                 v = subf_and_value_list[k]
                 if v is not None and v != '' and len(k) == 1:
                     v = format_value(v)
-                    v = change_circ(v)
-                    if k in 'abcdefghijklmnopqrstuvwxyz123456789':
-                        value += u'^' + k + v
-                    elif k in '_':
+                    if '^' in v:
+                        v = change_circ(v)
+                    if k in SUBFIELDS:
+                        value.append(u'^' + k + v)
+                    elif k == '_':
                         first = v
         except Exception as e:
             utils.debbuging('format_subfields')
             utils.debbuging(e)
             utils.debbuging(subf_and_value_list)
-            utils.debbuging(first + value)
-        return first + value
+            utils.debbuging(first + u''.join(value))
+        return first + u''.join(value)
 
-    def tag_content(self, tag, value):
+    def tag_content(self, tag, value, formatted=False):
+        """
+        formatted: value was already formatted by format_value (subfields)
+        """
         r = ''
         s = value
         if int(tag) <= 999:
             if value is not None and value != '':
                 try:
-                    tag = '000' + tag
-                    tag = tag[-3:]
-                    value = format_value(value)
+                    if not formatted:
+                        value = format_value(value)
                     #value = change_circ(value)
-                    r = '!v' + tag + '!' + value + '\n'
+                    r = tag_prefix(tag) + value + '\n'
                 except Exception as e:
                     utils.debbuging('tag_content: ')
                     utils.debbuging(e)
@@ -144,71 +238,41 @@ class IDFile(object):
         return r
 
     def read(self, filename):
-        rec_list = []
-        record = {}
-        for line in open(filename, 'r').readlines():
-            line = line.strip()
-            if not isinstance(line, unicode):
-                line = line.decode('iso-8859-1')
-            if '!ID ' in line:
-                if len(record) > 0:
-                    rec_list.append(self.simplify_record(record))
-                record = {}
-            else:
-                item = line.split('!')
-                tag = None
-                if len(item) == 3:
-                    ign, tag, content = item
-                elif len(item) > 3:
-                    tag = item[1]
-                    content = line[6:]
-                if tag is not None and content != '':
-                    tag = str(int(tag[1:]))
-                    if not tag in record.keys():
-                        record[tag] = []
-                    content = content.replace('^', 'BREAKSUBF^')
-                    subfields = content.split('BREAKSUBF')
-                    content = {}
-                    for subf in subfields:
-                        if subf.startswith('^'):
-                            c = subf[1]
-                            v = subf[2:]
-                        else:
-                            if len(subfields) == 1:
-                                c = ''
-                                v = subf
-                            else:
-                                c = '_'
-                                v = subf
-                        if len(c) > 0:
-                            content[c] = v
-                        else:
-                            content = v
-                    record[tag].append(content)
-
+        return [record.to_dict() for record in self.iter_records(filename)]
+
+    def iter_records(self, filename):
+        """
+        Yields the records of filename as IDRecord, lazily
+        """
+        tags = {}
+        fields = []
+        for line in iter_lines(filename):
+            line = line.strip(ID_FILE_WHITESPACE)
+            start = line[0:2]
+            if start == u'!v':
+                end = line.find(u'!', 2)
+                if end > 2 and len(line) > end + 1:
+                    tag = tags.get(line[2:end])
+                    if tag is None:
+                        tag = tags[line[2:end]] = str(int(line[2:end]))
+                    content = line[end + 1:]
+                    fields.append((tag, subfields(content) if u'^' in content else content))
+            elif start == u'!I' and line.startswith(u'!ID '):
+                if len(fields) > 0:
+                    yield IDRecord(fields)
+                fields = []
         # last record
-        if len(record) > 0:
-            rec_list.append(self.simplify_record(record))
-
-        return rec_list
-
-    def simplify_record(self, record):
-        for tag, content in record.items():
-            if len(content) == 1:
-                record[tag] = content[0]
-        return record
+        if len(fields) > 0:
+            yield IDRecord(fields)
 
     def save(self, filename, records):
         path = os.path.dirname(filename)
         if not os.path.isdir(path):
             os.makedirs(path)
-        content = self._format_file(records)
-
-        if isinstance(content, unicode):
-            content = u_encode(content, 'iso-8859-1')
-            content = content.replace('<PRESERVECIRC/>', '&#94;')
         try:
-            open(filename, 'w').write(content)
+            with open(filename, 'wb') as f:
+                for content in self._format_file(records):
+                    f.write(content)
         except Exception as e:
             utils.debbuging('saving...')
             utils.debbuging(e)
@@ -217,7 +281,8 @@ class IDFile(object):
 
 class CISIS(object):
 
-    def __init__(self, cisis_path):
+    def __init__(self, cisis_path, runner=None):
+        self.runner = runner if runner is not None else CommandRunner()
         cisis_path = cisis_path.replace('\\', '/')
         if os.path.exists(cisis_path):
             self.cisis_path = cisis_path
@@ -226,19 +291,19 @@ class CISIS(object):
 
     def crunchmf(self, mst_filename, wmst_filename):
         cmd = self.cisis_path + '/crunchmf ' + mst_filename + ' ' + wmst_filename
-        run_command(cmd)
+        self.runner.run(cmd)
 
     def id2i(self, id_filename, mst_filename):
         cmd = self.cisis_path + '/id2i ' + id_filename + ' create=' + mst_filename
-        run_command(cmd)
+        self.runner.run(cmd)
 
     def append(self, src, dest):
         cmd = self.cisis_path + '/mx ' + src + '  append=' + dest + ' now -all'
-        run_command(cmd)
+        self.runner.run(cmd)
 
     def create(self, src, dest):
         cmd = self.cisis_path + '/mx ' + src + ' create=' + dest + ' now -all'
-        run_command(cmd)
+        self.runner.run(cmd)
 
     def append_id_to_master(self, id_filename, mst_filename, reset):
         if reset:
@@ -247,41 +312,37 @@ class CISIS(object):
             temp = id_filename.replace('.id', '')
             self.id2i(id_filename, temp)
             self.append(temp, mst_filename)
-            try:
-                os.unlink(temp + '.mst')
-                os.unlink(temp + '.xrf')
-            except:
-                pass
+            self.runner.delete_files([temp + '.mst', temp + '.xrf'])
 
     def i2id(self, mst_filename, id_filename):
         cmd = self.cisis_path + '/i2id ' + mst_filename + ' > ' + id_filename
-        run_command(cmd)
+        self.runner.run(cmd)
 
     def mst2iso(self, mst_filename, iso_filename):
         cmd = self.cisis_path + '/mx ' + mst_filename + ' iso=' + iso_filename + ' now -all'
-        run_command(cmd)
+        self.runner.run(cmd)
 
     def iso2mst(self, iso_filename, mst_filename):
         cmd = self.cisis_path + '/mx iso=' + iso_filename + ' create=' + mst_filename + ' now -all'
-        run_command(cmd)
+        self.runner.run(cmd)
 
     def copy_record(self, src_mst_filename, mfn, dest_mst_filename):
         cmd = self.cisis_path + '/mx ' + src_mst_filename + ' from=' + mfn + ' count=1 ' + ' append=' + dest_mst_filename + ' now -all'
-        run_command(cmd)
+        self.runner.run(cmd)
 
     def modify_records(self, mst_filename, proc):
         cmd = self.cisis_path + '/mx ' + mst_filename + ' "proc=' + proc + '" copy=' + mst_filename + ' now -all'
-        run_command(cmd)
+        self.runner.run(cmd)
 
     def find_record(self, mst_filename, expression):
         r = mst_filename + expression
         cmd = self.cisis_path + '/mx ' + mst_filename + ' "bool=' + expression + '"  lw=999 "pft=mfn/" now > ' + r
-        run_command(cmd)
+        self.runner.run(cmd)
         return [l.strip().decode('utf-8') for l in open(r, 'r').readlines()]
 
     def new(self, mst_filename):
         cmd = self.cisis_path + '/mx null count=0 create="' + mst_filename + '" now -all'
-        run_command(cmd)
+        self.runner.run(cmd)
 
     def search(self, mst_filename, expression, result_filename):
         if os.path.isfile(result_filename + '.mst'):
@@ -289,11 +350,11 @@ class CISIS(object):
             os.unlink(result_filename + '.xrf')
         cmd = self.cisis_path + '/mx btell=0 ' + mst_filename + ' "bool=' + expression + '"  lw=999 append=' + result_filename + ' now -all'
         #print(type(cmd))
-        run_command(cmd)
+        self.runner.run(cmd)
 
     def generate_indexes(self, mst_filename, fst_filename, inverted_filename):
         cmd = self.cisis_path + '/mx ' + mst_filename + ' fst=@' + fst_filename + ' fullinv=' + inverted_filename
-        run_command(cmd)
+        self.runner.run(cmd)
 
     def is_readable(self, mst_filename):
         s = ''
@@ -302,7 +363,7 @@ class CISIS(object):
             temp_file.close()
 
             cmd = self.cisis_path + '/mx ' + mst_filename + ' +control now > ' + temp_file.name.replace('\\', '/')
-            run_command(cmd)
+            self.runner.run(cmd)
             #print(cmd)
             if os.path.isfile(temp_file.name):
                 s = open(temp_file.name, 'r').read()
@@ -319,21 +380,45 @@ class UCISIS(object):
     def __init__(self, cisis1030, cisis1660):
         self.cisis1030 = cisis1030
         self.cisis1660 = cisis1660
+        # both builds share the runner, so the timing has all the calls
+        self.runner = cisis1030.runner
+        self.cisis1660.runner = self.runner
+        self._versions = {}
 
     def cisis(self, mst_filename):
         if os.path.isfile(mst_filename + '.mst'):
-            if self.cisis1030.is_readable(mst_filename):
+            v = self.version(mst_filename)
+            if v == '1030':
                 return self.cisis1030
-            elif self.cisis1660.is_readable(mst_filename):
+            elif v == '1660':
                 return self.cisis1660
         else:
             return self.cisis1030
 
     def version(self, mst_filename):
-        if self.cisis1030.is_readable(mst_filename):
-            return '1030'
-        elif self.cisis1660.is_readable(mst_filename):
-            return '1660'
+        """
+        Returns '1030' or '1660'
+        The result is kept until the master file is modified (mtime and size)
+        """
+        if not os.path.isfile(mst_filename + '.mst'):
+            return None
+        stat = os.stat(mst_filename + '.mst')
+        key = (stat.st_mtime, stat.st_size)
+        cached = self._versions.get(mst_filename)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        v = None
+        try:
+            v = dbm_isis_mst.MasterFile(mst_filename).version
+        except (dbm_isis_mst.MasterFileError, IOError, struct.error):
+            pass
+        if v is None:
+            if self.cisis1030.is_readable(mst_filename):
+                v = '1030'
+            elif self.cisis1660.is_readable(mst_filename):
+                v = '1660'
+        self._versions[mst_filename] = (key, v)
+        return v
 
     def convert1660to1030(self, mst_filename):
         if os.path.isfile(mst_filename + '.mst'):
@@ -341,7 +426,9 @@ class UCISIS(object):
             temp_file.close()
             self.cisis1660.mst2iso(mst_filename, temp_file.name)
             self.cisis1030.iso2mst(temp_file.name, mst_filename)
-            os.unlink(temp_file.name)
+            self.runner.delete_files([temp_file.name])
+            if mst_filename in self._versions.keys():
+                del self._versions[mst_filename]
 
     def crunchmf(self, mst_filename, wmst_filename):
         self.cisis(mst_filename).crunchmf(mst_filename, wmst_filename)
@@ -422,7 +509,98 @@ class IsisDAO(object):
         self.cisis.append_id_to_master(id_filename, db_filename, False)
         self.update_indexes(db_filename, fst_filename)
 
+    def save_id_files(self, id_filenames, db_filename, fst_filename=None, reset=True):
+        """
+        Creates (reset=True) or appends to db_filename the records of
+        id_filenames, in this order, running id2i only once
+        """
+        path = os.path.dirname(db_filename)
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        temp_file = NamedTemporaryFile(delete=False, suffix='.id')
+        index = 0
+        for id_filename in id_filenames:
+            for line in open(id_filename, 'rb'):
+                if line.startswith('!ID '):
+                    index += 1
+                    line = IDFile()._format_id(index)
+                temp_file.write(line)
+        temp_file.close()
+        if index > 0:
+            self.cisis.append_id_to_master(temp_file.name, db_filename, reset)
+        self.cisis.runner.delete_files([temp_file.name])
+        self.update_indexes(db_filename, fst_filename)
+
+    def update_id_files(self, id_filenames, db_filename, fst_filename=None):
+        """
+        Incremental version of save_id_files
+        db_filename.idlist registers the id files (and their size and mtime)
+        which are in db_filename. If all of them are unchanged, only the new
+        id files are appended. Otherwise, db_filename is recreated.
+        Returns the list of id files which were (re)loaded
+        """
+        current = [(f, id_file_stat(f)) for f in id_filenames]
+        registered, mst_stat = self.get_id_list(db_filename)
+        if mst_stat is not None and mst_stat == mst_file_stat(db_filename):
+            _current = dict(current)
+            if all([_current.get(f) == stat for f, stat in registered]):
+                registered_files = [f for f, stat in registered]
+                new = [(f, stat) for f, stat in current if not f in registered_files]
+                if len(new) > 0:
+                    self.save_id_files([f for f, stat in new], db_filename, fst_filename, False)
+                    self.save_id_list(db_filename, registered + new)
+                return [f for f, stat in new]
+        self.save_id_files(id_filenames, db_filename, fst_filename)
+        self.save_id_list(db_filename, current)
+        return id_filenames
+
+    def get_id_list(self, db_filename):
+        registered = []
+        mst_stat = None
+        if os.path.isfile(db_filename + '.idlist'):
+            for line in open(db_filename + '.idlist', 'r').readlines():
+                items = line.rstrip('\n').split('\t')
+                if len(items) == 2 and items[0] == '.mst':
+                    mst_stat = items[1]
+                elif len(items) == 2:
+                    registered.append((items[0], items[1]))
+        return (registered, mst_stat)
+
+    def save_id_list(self, db_filename, id_files):
+        lines = ['.mst\t' + mst_file_stat(db_filename)]
+        lines.extend([f + '\t' + stat for f, stat in id_files])
+        open(db_filename + '.idlist', 'w').write('\n'.join(lines) + '\n')
+
+    def iter_records(self, db_filename, mfns=None):
+        """
+        Reads the records directly from db_filename.mst/.xrf, lazily
+        Same records as IDFile.read of the i2id output
+        mfns: sorted list of mfn to read, all the records if None
+        """
+        for mfn, fields in dbm_isis_mst.MasterFile(db_filename).iter_fields(mfns):
+            fields = [(str(tag), value.rstrip(ID_FILE_WHITESPACE).decode('iso-8859-1')) for tag, value in fields]
+            fields = [(tag, subfields(value)) for tag, value in fields if value != '']
+            if len(fields) > 0:
+                yield IDRecord(fields).to_dict()
+
+    def search_mfns(self, db_filename, expr):
+        """
+        Returns the sorted list of mfn of the records which match expr,
+        looking up the inverted file db_filename (generated by update_indexes)
+        """
+        master = dbm_isis_mst.MasterFile(db_filename)
+        return dbm_isis_inv.InvertedFile(db_filename, master.next_mfn).search(expr)
+
     def get_records(self, db_filename, expr=None):
+        if not os.path.isfile(db_filename + '.mst'):
+            return []
+        try:
+            mfns = None if expr is None else self.search_mfns(db_filename, expr)
+            return list(self.iter_records(db_filename, mfns))
+        except (dbm_isis_mst.MasterFileError, dbm_isis_inv.InvertedFileError, IOError, struct.error) as e:
+            utils.debugging('get_records: native reader failed, using cisis:')
+            utils.debugging(e)
+
         temp_dir = None
         if expr is None:
             base = db_filename
@@ -456,6 +634,53 @@ class IsisDAO(object):
         IDFile(content_formatter).save(id_filename, records)
 
 
+class CommandRunner(object):
+    """
+    Runs the cisis commands, registering the number of calls and the elapsed
+    time of each program (mx, id2i, i2id, ...)
+    """
+
+    def __init__(self):
+        self.timing = {}
+
+    def run(self, cmd):
+        start = time.time()
+        run_command(cmd)
+        elapsed = time.time() - start
+        program = os.path.basename(cmd.split(' ')[0])
+        calls, total = self.timing.get(program, (0, 0.0))
+        self.timing[program] = (calls + 1, total + elapsed)
+
+    def delete_files(self, filenames):
+        for filename in filenames:
+            try:
+                os.unlink(filename)
+            except:
+                pass
+
+    def merge(self, timing):
+        for program, (calls, total) in timing.items():
+            _calls, _total = self.timing.get(program, (0, 0.0))
+            self.timing[program] = (_calls + calls, _total + total)
+
+    def report(self):
+        lines = []
+        for program in sorted(self.timing.keys()):
+            calls, total = self.timing[program]
+            lines.append(program + ': ' + str(calls) + ' call(s), ' + '%.2f' % total + 's')
+        return '\n'.join(lines)
+
+
+def id_file_stat(filename):
+    stat = os.stat(filename)
+    return str(stat.st_size) + ' ' + repr(stat.st_mtime)
+
+
+def mst_file_stat(db_filename):
+    if os.path.isfile(db_filename + '.mst'):
+        return id_file_stat(db_filename + '.mst')
+
+
 def run_command(cmd):
     if isinstance(cmd, unicode):
         #print(cmd)
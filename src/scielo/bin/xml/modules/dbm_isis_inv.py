@@ -0,0 +1,326 @@
+# coding=utf-8
+
+"""
+Native search over ISIS inverted files (.cnt/.n01/.n02/.l01/.l02/.ifp)
+
+Looks up the terms generated by the FST (fullinv) and evaluates the boolean
+expressions built by DBManager (terms connected by OR/AND/+/*, with
+parentheses), without running mx and without creating a result master file.
+
+Structures which are not recognized raise InvertedFileError, so the caller
+can use mx instead.
+"""
+
+import os
+import re
+import struct
+
+
+IFP_BLOCK_SIZE = 512
+IFP_WORD = struct.Struct('<i')
+IFP_WORDS_PER_BLOCK = IFP_BLOCK_SIZE / 4 - 1
+IFP_HEADER_WORDS = 5
+POSTING_SIZE = 8
+
+SHORT_KEY_SIZE = 10
+LONG_KEY_SIZE = 30
+
+CNT_RECORD = struct.Struct('<hhhhhhiiih')
+
+OPERATORS = {'OR': 'OR', '+': 'OR', 'AND': 'AND', '*': 'AND'}
+EXPRESSION_TOKENS = re.compile(r'(\(|\)|\+|\*|\s+OR\s+|\s+AND\s+)', re.IGNORECASE)
+UNSUPPORTED_TERM_CHARS = '$^"'
+
+
+class InvertedFileError(Exception):
+    pass
+
+
+class BTree(object):
+    """
+    One of the B*trees of the inverted file: n01/l01 (keys up to 10 chars)
+    or n02/l02 (keys up to 30 chars)
+    """
+
+    def __init__(self, inverted_filename, tree_id, cnt):
+        idtype, ordn, ordf, n, k, liv, posrx, nmaxpos, fmaxpos, abnormal = cnt
+        self.key_size = SHORT_KEY_SIZE if tree_id == 1 else LONG_KEY_SIZE
+        self.liv = liv
+        self.posrx = posrx
+        self.node_filename = inverted_filename + '.n0' + str(tree_id)
+        self.leaf_filename = inverted_filename + '.l0' + str(tree_id)
+        self.node = None
+        if liv >= 0:
+            # liv < 0: the root is a leaf, there is no node
+            self.node = self._detect_struct(self.node_filename, 2 * ordn, '<ihh', ['<%dsi', '<%dsxxi'])
+        self.leaf = self._detect_struct(self.leaf_filename, 2 * ordf, '<ihhi', ['<%dsii', '<%dsxxii'])
+
+    def _detect_struct(self, filename, max_keys, header_format, item_formats):
+        """
+        Returns (header, item, max_keys, record size) of the packed or aligned
+        structure which matches the records of filename
+        """
+        if not os.path.isfile(filename):
+            raise InvertedFileError('Missing ' + filename)
+        file_size = os.path.getsize(filename)
+        header = struct.Struct(header_format)
+        with open(filename, 'rb') as f:
+            for item_format in item_formats:
+                item = struct.Struct(item_format % self.key_size)
+                structure = (header, item, max_keys, header.size + max_keys * item.size)
+                if file_size == 0 or file_size % structure[3] != 0:
+                    continue
+                try:
+                    keys = [i[0] for i in self._read(f, structure, 1)]
+                    if file_size > structure[3]:
+                        self._read(f, structure, 2)
+                except InvertedFileError:
+                    continue
+                if keys == sorted(keys):
+                    return structure
+        raise InvertedFileError('Unknown structure: ' + filename)
+
+    def _read(self, f, structure, position):
+        header, item, max_keys, size = structure
+        f.seek((position - 1) * size)
+        data = f.read(size)
+        if len(data) < size:
+            raise InvertedFileError('Invalid position ' + str(position) + ': ' + f.name)
+        values = header.unpack_from(data)
+        pos, ock = values[0:2]
+        if pos != position or not 0 < ock <= max_keys:
+            raise InvertedFileError('Invalid record ' + str(position) + ': ' + f.name)
+        items = [item.unpack_from(data, header.size + i * item.size) for i in range(0, ock)]
+        return items
+
+    def find(self, key):
+        """
+        Returns (ifp block, ifp position) of the key postings, or None
+        """
+        key = key.ljust(self.key_size)
+        punt = self.posrx if self.liv >= 0 else -abs(self.posrx)
+        if punt == 0:
+            return None
+        with open(self.node_filename, 'rb') as nodes:
+            while punt > 0:
+                items = self._read(nodes, self.node, punt)
+                selected = items[0]
+                for item in items[1:]:
+                    if item[0] > key:
+                        break
+                    selected = item
+                punt = selected[1]
+        with open(self.leaf_filename, 'rb') as leaves:
+            for item in self._read(leaves, self.leaf, -punt):
+                if item[0] == key:
+                    return (item[1], item[2])
+        return None
+
+
+class InvertedFile(object):
+
+    def __init__(self, inverted_filename, next_mfn=None):
+        """
+        next_mfn: next mfn of the master file, used to check the postings
+        """
+        self.inverted_filename = inverted_filename
+        self.ifp_filename = inverted_filename + '.ifp'
+        self.next_mfn = next_mfn
+        self._trees = None
+        self._word_offset = None
+
+    def exists(self):
+        return all([os.path.isfile(self.inverted_filename + ext) for ext in ['.cnt', '.n01', '.l01', '.ifp']])
+
+    @property
+    def trees(self):
+        if self._trees is None:
+            cnt_filename = self.inverted_filename + '.cnt'
+            if not os.path.isfile(cnt_filename):
+                raise InvertedFileError('Missing ' + cnt_filename)
+            data = open(cnt_filename, 'rb').read()
+            record_size = len(data) / 2
+            if record_size < CNT_RECORD.size:
+                raise InvertedFileError('Invalid ' + cnt_filename)
+            self._trees = {}
+            for i in range(0, 2):
+                cnt = CNT_RECORD.unpack_from(data, i * record_size)
+                if cnt[0] == 1 or (cnt[0] == 2 and self.has_long_keys(cnt)):
+                    self._trees[cnt[0]] = BTree(self.inverted_filename, cnt[0], cnt)
+            if not 1 in self._trees.keys():
+                raise InvertedFileError('Invalid ' + cnt_filename)
+        return self._trees
+
+    def has_long_keys(self, cnt):
+        """
+        fullinv creates empty .n02 and .l02 (posrx=0) if no key has more than 10 chars
+        """
+        liv, posrx = cnt[5:7]
+        if posrx == 0:
+            return False
+        leaf_filename = self.inverted_filename + '.l02'
+        if not os.path.isfile(leaf_filename) or os.path.getsize(leaf_filename) == 0:
+            return False
+        node_filename = self.inverted_filename + '.n02'
+        if liv >= 0 and (not os.path.isfile(node_filename) or os.path.getsize(node_filename) == 0):
+            return False
+        return True
+
+    def key(self, term):
+        """
+        Returns the term as it is stored by fullinv: upper case, up to 30 chars
+        """
+        if isinstance(term, unicode):
+            try:
+                term = term.encode('ascii')
+            except UnicodeEncodeError:
+                raise InvertedFileError('Non ASCII term: ' + term.encode('utf-8'))
+        for c in UNSUPPORTED_TERM_CHARS:
+            if c in term:
+                raise InvertedFileError('Unsupported term: ' + term)
+        return term.strip().upper()[0:LONG_KEY_SIZE].rstrip()
+
+    def postings(self, term):
+        """
+        Returns the set of mfn of the records which has the term
+        """
+        key = self.key(term)
+        if key == '':
+            return set()
+        tree = self.trees.get(1 if len(key) <= SHORT_KEY_SIZE else 2)
+        found = None if tree is None else tree.find(key)
+        if found is None:
+            return set()
+        with open(self.ifp_filename, 'rb') as ifp:
+            return self._read_postings(ifp, found[0], found[1])
+
+    def _read_words(self, ifp, word_index, count, unit=1):
+        """
+        Returns count words from word_index on, skipping the block number
+        which starts each block
+        unit: number of words of the items, which are never split between
+        two blocks (the rest of the block is padding)
+        """
+        if word_index < 0:
+            raise InvertedFileError('Invalid position: ' + self.ifp_filename)
+        data = []
+        while count > 0:
+            block, index = divmod(word_index, IFP_WORDS_PER_BLOCK)
+            n = min(count, (IFP_WORDS_PER_BLOCK - index) / unit * unit)
+            if n == 0:
+                word_index = (block + 1) * IFP_WORDS_PER_BLOCK
+                continue
+            ifp.seek(block * IFP_BLOCK_SIZE)
+            block_number = ifp.read(IFP_WORD.size)
+            if len(block_number) < IFP_WORD.size or IFP_WORD.unpack(block_number)[0] != block + 1:
+                raise InvertedFileError('Invalid block ' + str(block + 1) + ': ' + self.ifp_filename)
+            ifp.seek(index * IFP_WORD.size, 1)
+            words = ifp.read(n * IFP_WORD.size)
+            if len(words) < n * IFP_WORD.size:
+                raise InvertedFileError('Invalid position: ' + self.ifp_filename)
+            data.append(words)
+            word_index += n
+            count -= n
+        return ''.join(data)
+
+    def _segments(self, ifp, word_index):
+        while word_index is not None:
+            header = struct.unpack('<5i', self._read_words(ifp, word_index, IFP_HEADER_WORDS))
+            nxtb, nxtp, totp, segp, segc = header
+            if not (0 < segp <= segc and segp <= totp and nxtb >= 0 and nxtp >= 0):
+                raise InvertedFileError('Invalid postings header: ' + self.ifp_filename)
+            data = self._read_words(ifp, word_index + IFP_HEADER_WORDS, segp * POSTING_SIZE / 4, POSTING_SIZE / 4)
+            yield data
+            word_index = self._word_index(nxtb, nxtp) if nxtb > 0 else None
+
+    def _word_index(self, block, position):
+        return (block - 1) * IFP_WORDS_PER_BLOCK + position + self._word_offset
+
+    def _read_postings(self, ifp, block, position):
+        if self._word_offset is None:
+            # position is the index of the word in the block, with or
+            # without the block number word, depending on the cisis build
+            for offset in [0, -1]:
+                self._word_offset = offset
+                try:
+                    return self._read_postings(ifp, block, position)
+                except (InvertedFileError, struct.error):
+                    pass
+            self._word_offset = None
+            raise InvertedFileError('Unknown postings structure: ' + self.ifp_filename)
+
+        mfns = set()
+        for data in self._segments(ifp, self._word_index(block, position)):
+            previous = 0
+            for i in range(0, len(data), POSTING_SIZE):
+                # posting: mfn (3 bytes), tag (2), occ (1), cnt (2), most significant byte first
+                b = struct.unpack_from('>3B', data, i)
+                mfn = (b[0] << 16) | (b[1] << 8) | b[2]
+                if mfn < previous or mfn < 1 or (self.next_mfn is not None and mfn >= self.next_mfn):
+                    raise InvertedFileError('Invalid posting: ' + self.ifp_filename)
+                previous = mfn
+                mfns.add(mfn)
+        return mfns
+
+    def search(self, expression):
+        """
+        Returns the sorted list of mfn of the records which match expression
+        """
+        tokens = parse_expression(expression)
+        return sorted(self._evaluate(tokens))
+
+    def _evaluate(self, node):
+        if isinstance(node, tuple):
+            operator, left, right = node
+            if operator == 'OR':
+                return self._evaluate(left) | self._evaluate(right)
+            return self._evaluate(left) & self._evaluate(right)
+        return self.postings(node)
+
+
+def parse_expression(expression):
+    """
+    Returns the expression as a tree of (operator, left, right), whose
+    leaves are the terms. AND has higher precedence than OR
+    """
+    tokens = []
+    for token in EXPRESSION_TOKENS.split(expression):
+        if token.strip() in ['(', ')']:
+            tokens.append(token.strip())
+        elif token.strip().upper() in OPERATORS.keys():
+            tokens.append(OPERATORS[token.strip().upper()])
+        elif token.strip() != '':
+            tokens.append(('TERM', token.strip()))
+    tree, i = _parse_or(tokens, 0)
+    if i != len(tokens):
+        raise InvertedFileError('Invalid expression: ' + expression)
+    return tree
+
+
+def _parse_or(tokens, i):
+    left, i = _parse_and(tokens, i)
+    while i < len(tokens) and tokens[i] == 'OR':
+        right, i = _parse_and(tokens, i + 1)
+        left = ('OR', left, right)
+    return (left, i)
+
+
+def _parse_and(tokens, i):
+    left, i = _parse_term(tokens, i)
+    while i < len(tokens) and tokens[i] == 'AND':
+        right, i = _parse_term(tokens, i + 1)
+        left = ('AND', left, right)
+    return (left, i)
+
+
+def _parse_term(tokens, i):
+    if i >= len(tokens):
+        raise InvertedFileError('Incomplete expression')
+    if tokens[i] == '(':
+        tree, i = _parse_or(tokens, i + 1)
+        if i >= len(tokens) or tokens[i] != ')':
+            raise InvertedFileError('Unbalanced parentheses')
+        return (tree, i + 1)
+    if isinstance(tokens[i], tuple):
+        return (tokens[i][1], i + 1)
+    raise InvertedFileError('Unexpected ' + tokens[i])
@@ -0,0 +1,198 @@
+# coding=utf-8
+
+"""
+Native reader of ISIS master files (.mst/.xrf)
+
+Reads the records directly from the files generated by CISIS, so there is no
+need to run mx/i2id to get the content of a master file.
+
+Supported layouts:
+- 1030: CISIS standard, 18-bytes leader and 6-bytes directory entries
+- 1660: CISIS FFI (big records), 32-bits record length, base and field
+  positions, aligned (default) or packed structures
+"""
+
+import os
+import struct
+
+
+MST_BLOCK_SIZE = 512
+XRF_BLOCK_SIZE = 512
+XRF_ENTRIES_PER_BLOCK = 127
+XRF_SHIFT = 11
+XRF_OFFSET_MASK = 0x1ff
+
+CONTROL_RECORD = struct.Struct('<iiiHHiiii')
+XRF_BLOCK = struct.Struct('<' + 'i' * (XRF_ENTRIES_PER_BLOCK + 1))
+XRF_ENTRY = struct.Struct('<i')
+
+RECORD_ACTIVE = 0
+
+
+class MasterFileError(Exception):
+    pass
+
+
+class MasterLayout(object):
+    """
+    Leader fields: mfn, mfrl, mfbwb, mfbwp, base, nvf, status
+    Directory entry fields: tag, pos, len
+    """
+
+    def __init__(self, version, leader_format, directory_format):
+        self.version = version
+        self.leader = struct.Struct(leader_format)
+        self.directory = struct.Struct(directory_format)
+
+    def read_leader(self, data, mfn):
+        if len(data) < self.leader.size:
+            return None
+        _mfn, mfrl, mfbwb, mfbwp, base, nvf, status = self.leader.unpack_from(data)
+        mfrl = abs(mfrl)
+        if _mfn != mfn:
+            return None
+        if base != self.leader.size + nvf * self.directory.size:
+            return None
+        if mfrl < base:
+            return None
+        return (mfrl, base, nvf, status)
+
+
+LAYOUTS = [
+    MasterLayout('1030', '<ihiHHHH', '<HHH'),
+    MasterLayout('1660', '<iiiHxxiHH', '<HxxII'),
+    MasterLayout('1660', '<iiiHiHH', '<HII'),
+]
+MAX_LEADER_SIZE = max([layout.leader.size for layout in LAYOUTS])
+
+
+class MasterFile(object):
+
+    def __init__(self, db_filename):
+        self.db_filename = db_filename
+        self.mst_filename = db_filename + '.mst'
+        self.xrf_filename = db_filename + '.xrf'
+        self.layout = None
+
+    def exists(self):
+        return os.path.isfile(self.mst_filename) and os.path.isfile(self.xrf_filename)
+
+    def control_record(self):
+        with open(self.mst_filename, 'rb') as mst:
+            data = mst.read(CONTROL_RECORD.size)
+        if len(data) < CONTROL_RECORD.size:
+            raise MasterFileError('Invalid control record: ' + self.mst_filename)
+        return CONTROL_RECORD.unpack(data)
+
+    @property
+    def next_mfn(self):
+        return self.control_record()[1]
+
+    @property
+    def version(self):
+        """
+        Returns '1030' or '1660', according to the layout of the first active record
+        None if the master file has no active record
+        """
+        if self.layout is None:
+            with open(self.mst_filename, 'rb') as mst:
+                for mfn, position in self.pointers():
+                    self._read_record(mst, mfn, position)
+                    break
+        return self.layout.version if self.layout is not None else None
+
+    def pointers(self):
+        """
+        Yields (mfn, position in .mst) of the active records, in mfn order
+        """
+        next_mfn = self.next_mfn
+        mfn = 0
+        with open(self.xrf_filename, 'rb') as xrf:
+            while mfn + 1 < next_mfn:
+                block = xrf.read(XRF_BLOCK_SIZE)
+                if len(block) < XRF_BLOCK_SIZE:
+                    break
+                values = XRF_BLOCK.unpack(block)
+                for pointer in values[1:]:
+                    mfn += 1
+                    if mfn >= next_mfn:
+                        break
+                    position = self._position(pointer)
+                    if position is not None:
+                        yield (mfn, position)
+                if values[0] < 0:
+                    break
+
+    def pointer(self, mfn):
+        """
+        Returns the position in .mst of the record mfn
+        None if the record does not exist or it is deleted
+        """
+        if mfn < 1 or mfn >= self.next_mfn:
+            return None
+        block_index, entry_index = divmod(mfn - 1, XRF_ENTRIES_PER_BLOCK)
+        with open(self.xrf_filename, 'rb') as xrf:
+            xrf.seek(block_index * XRF_BLOCK_SIZE + (entry_index + 1) * XRF_ENTRY.size)
+            data = xrf.read(XRF_ENTRY.size)
+        if len(data) < XRF_ENTRY.size:
+            return None
+        return self._position(XRF_ENTRY.unpack(data)[0])
+
+    def _position(self, pointer):
+        block = pointer >> XRF_SHIFT
+        if block > 0:
+            return (block - 1) * MST_BLOCK_SIZE + (pointer & XRF_OFFSET_MASK)
+
+    def _detect_layout(self, head, mfn):
+        for layout in LAYOUTS:
+            if layout.read_leader(head, mfn) is not None:
+                return layout
+        raise MasterFileError('Unknown master file layout: ' + self.mst_filename)
+
+    def _read_record(self, mst, mfn, position):
+        mst.seek(position)
+        head = mst.read(MAX_LEADER_SIZE)
+        if self.layout is None:
+            self.layout = self._detect_layout(head, mfn)
+        leader = self.layout.read_leader(head, mfn)
+        if leader is None:
+            raise MasterFileError('Invalid record ' + str(mfn) + ': ' + self.mst_filename)
+        mfrl, base, nvf, status = leader
+        if status != RECORD_ACTIVE:
+            return None
+        mst.seek(position)
+        data = mst.read(mfrl)
+        if len(data) < mfrl:
+            raise MasterFileError('Truncated record ' + str(mfn) + ': ' + self.mst_filename)
+        fields = []
+        directory = self.layout.directory
+        for i in range(0, nvf):
+            tag, pos, length = directory.unpack_from(data, self.layout.leader.size + i * directory.size)
+            start = base + pos
+            fields.append((tag, data[start:start + length]))
+        return fields
+
+    def iter_fields(self, mfns=None):
+        """
+        Yields (mfn, [(tag, raw value), ...]) of the active records, lazily
+        mfns: sorted list of mfn to read, all the records if None
+        The fields are in the directory order
+        """
+        if mfns is None:
+            pointers = self.pointers()
+        else:
+            pointers = ((mfn, self.pointer(mfn)) for mfn in mfns)
+        with open(self.mst_filename, 'rb') as mst:
+            for mfn, position in pointers:
+                if position is not None:
+                    fields = self._read_record(mst, mfn, position)
+                    if fields is not None:
+                        yield (mfn, fields)
+
+    def fields(self, mfn):
+        """
+        Returns [(tag, raw value), ...] of the record mfn
+        None if the record does not exist or it is deleted
+        """
+        for _mfn, fields in self.iter_fields([mfn]):
+            return fields
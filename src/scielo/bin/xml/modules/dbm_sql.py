@@ -1,68 +1,154 @@
 # coding=utf-8
 
+import os
 import sqlite3
+import thread
+import time
 import utils
 
 
+INSERT_BATCH_SIZE = 5000
+
+# connections reused by the queries, by database, process and thread
+connections = {}
+
+
+def rename_file(src, dst):
+    """
+    os.rename which also replaces dst on Windows, without removing it first
+    """
+    if os.name == 'nt':
+        import ctypes
+        MOVEFILE_REPLACE_EXISTING = 0x1
+        if not ctypes.windll.kernel32.MoveFileExW(unicode(src), unicode(dst), MOVEFILE_REPLACE_EXISTING):
+            raise ctypes.WinError()
+    else:
+        os.rename(src, dst)
+
+
 class SQL(object):
 
     def __init__(self, db_filename):
         self.db_filename = db_filename
 
-    def create_db(self, schema_filename):
-        with sqlite3.connect(self.db_filename) as conn:
-            print 'Creating schema'
-            with open(schema_filename, 'rt') as f:
-                schema = f.read()
-            conn.executescript(schema)
+    @property
+    def connection(self):
+        key = (self.db_filename, os.getpid(), thread.get_ident())
+        if connections.get(key) is None:
+            connections[key] = sqlite3.connect(self.db_filename)
+        return connections[key]
+
+    def close(self):
+        key = (self.db_filename, os.getpid(), thread.get_ident())
+        if connections.get(key) is not None:
+            connections[key].close()
+            del connections[key]
+
+    def create_db(self, schema_filename, data_items=None):
+        """
+        data_items: [(csv_filename, table_name, fields), ...], loaded after
+        the tables of the schema are created and before its indexes
+        """
+        self.close()
+        with open(schema_filename, 'rt') as f:
+            schema = f.read()
+        statements = [item.strip() + ';' for item in schema.split(';') if item.strip() != '']
+        tables_statements = [item for item in statements if not item.lower().startswith('create index')]
+        indexes_statements = [item for item in statements if item.lower().startswith('create index')]
 
-    def insert_data(self, csv_filename, table_name, fields):
         conn = sqlite3.connect(self.db_filename)
-        _fields = ', '.join(fields)
-
-        for row in open(csv_filename, 'r').readlines():
-            if not isinstance(row, unicode):
-                row = row.decode('utf-8')
-            row = row.strip()
-            items = row.split('\t')
-
-            if len(items) == len(fields):
-                _values = []
-                for item in items:
-                    if not '"' in item:
-                        _values.append('"' + item.replace('  ', ' ').strip() + '"')
-                    elif not "'" in item:
-                        _values.append("'" + item.replace('  ', ' ').strip() + "'")
-                    else:
-                        _values.append('`' + item.replace('  ', ' ').strip() + '`')
-                instruction = 'insert into ' + table_name + ' (' + _fields + ') ' + ' values (' + ', '.join(_values) + ')'
-                utils.debugging(instruction)
-                conn.execute(instruction + '\n')
-                conn.commit()
+        print 'Creating schema'
+        conn.executescript('\n'.join(tables_statements))
+        for csv_filename, table_name, fields in data_items or []:
+            self.insert_rows(conn, csv_filename, table_name, fields)
+        conn.commit()
+        conn.executescript('\n'.join(indexes_statements))
         conn.close()
 
-    def query(self, expr):
-        results = []
-        with sqlite3.connect(self.db_filename) as conn:
-            cursor = conn.cursor()
+    def replace_db(self, db_filename, keep_existing=False, attempts=3):
+        """
+        Replaces self.db_filename by db_filename, which is complete, so the
+        connections never see a database which is being created
+        keep_existing: if self.db_filename was created meanwhile (by another
+        process), it is used and db_filename is discarded
+        Returns True if db_filename replaced self.db_filename
+        """
+        self.close()
+        error = None
+        for attempt in range(attempts):
+            if keep_existing and os.path.isfile(self.db_filename):
+                break
             try:
-                cursor.execute(expr)
-                for row in cursor.fetchall():
-                    results.append(row)
-            except Exception as e:
-                utils.debugging('ERROR: query')
-                utils.debugging(expr)
+                rename_file(db_filename, self.db_filename)
+                return True
+            except OSError as e:
+                # Windows: self.db_filename is open by another process
+                error = e
+                utils.debugging('Unable to replace ' + self.db_filename)
                 utils.debugging(e)
+                time.sleep(1)
+        if not os.path.isfile(self.db_filename):
+            raise error
+        os.unlink(db_filename)
+        return False
+
+    def execute_script(self, script):
+        self.connection.executescript(script)
+        self.connection.commit()
+
+    def insert_data(self, csv_filename, table_name, fields):
+        conn = sqlite3.connect(self.db_filename)
+        self.insert_rows(conn, csv_filename, table_name, fields)
+        conn.commit()
         conn.close()
-        return results
 
-    def query_one(self, expr):
+    def insert_rows(self, conn, csv_filename, table_name, fields, batch_size=INSERT_BATCH_SIZE):
+        """
+        Inserts the rows of csv_filename (tab separated values) in batches
+        The caller commits the transaction
+        """
+        instruction = 'insert into ' + table_name + ' (' + ', '.join(fields) + ') values (' + ', '.join(['?' for field in fields]) + ')'
+        total = 0
+        rows = []
+        with open(csv_filename, 'r') as csv_file:
+            for row in csv_file:
+                if not isinstance(row, unicode):
+                    row = row.decode('utf-8')
+                items = row.strip().split('\t')
+                if len(items) == len(fields):
+                    rows.append(tuple([item.replace('  ', ' ').strip() for item in items]))
+                if len(rows) == batch_size:
+                    conn.executemany(instruction, rows)
+                    total += len(rows)
+                    rows = []
+        if len(rows) > 0:
+            conn.executemany(instruction, rows)
+            total += len(rows)
+        utils.debugging(instruction)
+        utils.debugging(str(total) + ' rows')
+
+    def query(self, expr, parameters=()):
+        """
+        expr: statement, which may have ? for the items of parameters
+        """
         results = []
-        with sqlite3.connect(self.db_filename) as conn:
-            cursor = conn.cursor()
-            cursor.execute(expr)
-            results = cursor.fetchone()
-        conn.close()
+        cursor = self.connection.cursor()
+        try:
+            cursor.execute(expr, parameters)
+            for row in cursor.fetchall():
+                results.append(row)
+        except Exception as e:
+            utils.debugging('ERROR: query')
+            utils.debugging(expr)
+            utils.debugging(e)
+        cursor.close()
+        return results
+
+    def query_one(self, expr, parameters=()):
+        cursor = self.connection.cursor()
+        cursor.execute(expr, parameters)
+        results = cursor.fetchone()
+        cursor.close()
         return results
 
     def get_select_statement(self, table_name, fields, where_expr=None):
@@ -82,3 +168,16 @@ class SQL(object):
                 expr.append(labels[i] + '="' + values[i] + '"')
         return connector.join(expr)
 
+    def format_parameters_expr(self, labels, values, connector=' OR '):
+        """
+        Returns (expr, parameters), which has labels[i]=? for the values which are not None
+        """
+        expr = []
+        parameters = []
+        for label, value in zip(labels, values):
+            if value is not None:
+                if not isinstance(value, unicode):
+                    value = value.decode('utf-8')
+                expr.append(label + '=?')
+                parameters.append(value)
+        return (connector.join(expr), parameters)
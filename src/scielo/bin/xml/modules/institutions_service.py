@@ -1,6 +1,11 @@
 # coding=utf-8
 
 import os
+import re
+import sqlite3
+import tempfile
+import threading
+import time
 import utils
 import dbm_sql
 
@@ -15,6 +20,16 @@ orgname_list = None
 location_list = None
 
 previous_requests = {}
+wayta_cache = None
+wayta_requests_running = {}
+wayta_requests_lock = threading.Lock()
+
+WAYTA_URL = os.environ.get('WAYTA_URL', 'http://wayta.scielo.org/api/v1/institution')
+WAYTA_OFFLINE = os.environ.get('WAYTA_OFFLINE', 'no') == 'yes'
+WAYTA_TIMEOUT = 30
+WAYTA_CACHE_TTL = int(os.environ.get('WAYTA_CACHE_TTL', 30 * 24 * 60 * 60))
+WAYTA_CACHE_MAX_ITEMS = 50000
+shared_org_manager = None
 
 
 def normalize_term(term):
@@ -70,15 +85,80 @@ class OrgDBManager(object):
         self.schema_filename = curr_path + '/xc.sql'
         self.fields = ['name', 'city', 'state', 'country_code', 'country_name']
         self.table_name = 'institutions'
+        self.fts_table_name = 'institutions_fts'
+        self._has_fts_index = None
         if not os.path.isfile(self.db_filename):
-            self.create_db()
+            self.create_db(keep_existing=True)
+        else:
+            self.update_schema()
         self.normalized_country_items = self.get_country_items()
-
-    def create_db(self):
-        if os.path.isfile(self.db_filename):
-            os.unlink(self.db_filename)
-        self.sql.create_db(self.schema_filename)
-        self.sql.insert_data(self.csv_filename, self.table_name, self.fields)
+        self._country_names_index = None
+
+    def create_db(self, keep_existing=False):
+        """
+        Creates the database in a temporary file of its own, which replaces xc.db when it is complete
+        keep_existing: xc.db created meanwhile by another converter is used instead
+        """
+        handle, tmp_filename = tempfile.mkstemp(dir=os.path.dirname(self.db_filename), suffix='.db')
+        os.close(handle)
+        tmp_sql = dbm_sql.SQL(tmp_filename)
+        try:
+            tmp_sql.create_db(self.schema_filename, [(self.csv_filename, self.table_name, self.fields)])
+            self.create_fts_index(tmp_sql)
+        except:
+            tmp_sql.close()
+            os.unlink(tmp_filename)
+            raise
+        tmp_sql.close()
+        self.sql.replace_db(tmp_filename, keep_existing)
+        self._has_fts_index = None
+        self.normalized_country_items = self.get_country_items()
+        self._country_names_index = None
+
+    def update_schema(self):
+        """
+        Creates the indexes which are missing in databases created by previous versions
+        Nothing is written if they exist. If xc.db is read-only or locked,
+        the names are searched by LIKE, as in the previous versions
+        """
+        schema = open(self.schema_filename, 'rt').read()
+        names = re.findall(r'create index if not exists (\w+)', schema) + [self.fts_table_name]
+        existing = [row[0] for row in self.sql.query('select name from sqlite_master')]
+        if all([name in existing for name in names]):
+            return
+        try:
+            self.sql.execute_script(schema)
+        except sqlite3.Error as e:
+            utils.debugging('Unable to update ' + self.db_filename)
+            utils.debugging(e)
+            return
+        if not self.has_fts_index:
+            self.create_fts_index()
+
+    @property
+    def has_fts_index(self):
+        if self._has_fts_index is None:
+            self._has_fts_index = len(self.sql.query('select name from sqlite_master where name=?', (self.fts_table_name, ))) > 0
+        return self._has_fts_index
+
+    def create_fts_index(self, sql=None):
+        """
+        Creates the full text index (trigram) of the names, used by similar_institutions
+        sqlite older than 3.34 has no trigram tokenizer, then LIKE is used instead
+        """
+        if sql is None:
+            sql = self.sql
+        self._has_fts_index = None
+        try:
+            # in one transaction, so the table never exists without its content
+            sql.execute_script('begin; create virtual table ' + self.fts_table_name + ' using fts5(name, content=' + self.table_name + ", tokenize='trigram'); insert into " + self.fts_table_name + '(' + self.fts_table_name + ") values('rebuild'); commit;")
+        except sqlite3.Error as e:
+            utils.debugging('Unable to create ' + self.fts_table_name)
+            utils.debugging(e)
+            try:
+                sql.connection.rollback()
+            except sqlite3.Error:
+                pass
 
     def get_country_items(self):
         expr = self.sql.get_select_statement(self.table_name, ['country_name', 'country_code'], None)
@@ -90,8 +170,14 @@ class OrgDBManager(object):
                 items[country_name] = country_code
         return items
 
+    @property
+    def country_names_index(self):
+        if self._country_names_index is None:
+            self._country_names_index = utils.SimilarityIndex(self.normalized_country_items.keys())
+        return self._country_names_index
+
     def get_similar_country_names(self, country_name):
-        rate, most_similars = utils.most_similar(utils.similarity(self.normalized_country_items.keys(), country_name, 0.7))
+        rate, most_similars = utils.most_similar(self.country_names_index.similarity(country_name, 0.7))
         return most_similars
 
     def normalized_country_name(self, country_code, country_name):
@@ -121,39 +207,50 @@ class OrgDBManager(object):
         return results
 
     def get_countries_expr(self, country_names):
-        or_expr = self.sql.format_expr(['country_name' for item in country_names], country_names, ' OR ')
+        or_expr, parameters = self.sql.format_parameters_expr(['country_name' for item in country_names], country_names, ' OR ')
         if len(or_expr) > 0:
             or_expr = '(' + or_expr + ')'
-        return or_expr
+        return (or_expr, parameters)
+
+    def get_similar_names_expr(self, orgname):
+        words = orgname.split(' ')
+        if '' in words:
+            # name LIKE '%%' matches all the names
+            return ('', [])
+        if all([len(word) >= 3 for word in words]) and self.has_fts_index:
+            expr = 'rowid IN (select rowid from ' + self.fts_table_name + ' where ' + self.fts_table_name + ' MATCH ?)'
+            return (expr, [' OR '.join(['"' + word.replace('"', '""') + '"' for word in words])])
+        expr = '(' + ' OR '.join(['name LIKE ?' for word in words]) + ')'
+        return (expr, ['%' + word + '%' for word in words])
 
     def institution_exists(self, orgname, city, state, country_code, country_name):
         r = []
-        name_city_expr = self.sql.format_expr(['name', 'city'], [orgname, city], ' AND ')
-        country_expr = self.sql.format_expr(['country_code', 'country_name'], [country_code, country_name], ' OR ')
+        name_city_expr, name_city_parameters = self.sql.format_parameters_expr(['name', 'city'], [orgname, city], ' AND ')
+        country_expr, country_parameters = self.sql.format_parameters_expr(['country_code', 'country_name'], [country_code, country_name], ' OR ')
         if len(country_expr) > 0:
             country_expr = '(' + country_expr + ')'
 
         where_expr = ' AND '.join([item for item in [name_city_expr, country_expr] if item != ''])
         if len(where_expr) > 0:
             expr = self.sql.get_select_statement(self.table_name, self.fields, where_expr)
-            r = self.sql.query(expr)
+            r = self.sql.query(expr, name_city_parameters + country_parameters)
         return r
 
     def similar_institutions(self, orgname, city, state, country_code, country_name):
         r = []
 
-        similar_orgname_expr = ' OR '.join(['name LIKE ' + "'%" + word + "%'" for word in orgname.split(' ')])
-        if len(similar_orgname_expr) > 0:
-            similar_orgname_expr = '(' + similar_orgname_expr + ')'
-        country_expr = self.get_countries_expr(self.get_similar_country_names(country_name))
-        city_expr = self.sql.format_expr(['city'], [city], ' OR ')
-        country_code_expr = self.sql.format_expr(['country_code'], [country_code], ' OR ')
-        items = [item for item in [similar_orgname_expr, country_expr, city_expr, country_code_expr] if item != '']
-        where_expr = ' AND '.join(items)
+        items = []
+        items.append(self.get_similar_names_expr(orgname))
+        items.append(self.get_countries_expr(self.get_similar_country_names(country_name)))
+        items.append(self.sql.format_parameters_expr(['city'], [city], ' OR '))
+        items.append(self.sql.format_parameters_expr(['country_code'], [country_code], ' OR '))
+        items = [(expr, parameters) for expr, parameters in items if expr != '']
+        where_expr = ' AND '.join([expr for expr, parameters in items])
+        parameters = [parameter for expr, _parameters in items for parameter in _parameters]
 
-        expr = self.sql.get_select_statement(self.table_name, self.fields, where_expr)
+        expr = self.sql.get_select_statement(self.table_name, self.fields, where_expr if where_expr != '' else None)
 
-        r = self.sql.query(expr)
+        r = self.sql.query(expr, parameters)
         r = list(set(r))
         return r
 
@@ -171,32 +268,109 @@ def remove_sgml_tags(text):
     return r
 
 
+class WaytaCache(object):
+    """
+    Responses of wayta, stored in sqlite (wayta.db, next to xc.db)
+    The responses expire after WAYTA_CACHE_TTL seconds and the least
+    recently used are deleted when there are more than WAYTA_CACHE_MAX_ITEMS
+    """
+
+    def __init__(self, db_filename):
+        self.sql = dbm_sql.SQL(db_filename)
+        try:
+            self.sql.execute_script('create table if not exists wayta_requests (query text primary key, response text, created real, accessed real); create index if not exists wayta_requests_accessed on wayta_requests (accessed);')
+        except sqlite3.Error as e:
+            # read-only or locked: get and set do nothing
+            utils.debugging('Unable to create the wayta cache ' + db_filename)
+            utils.debugging(e)
+
+    def get(self, query, expired=False):
+        """
+        Returns the stored response of query, or None
+        expired: True to return also the expired response
+        """
+        try:
+            row = self.sql.query_one('select response, created from wayta_requests where query=?', (query, ))
+            if row is not None:
+                response, created = row
+                if expired or time.time() - created <= WAYTA_CACHE_TTL:
+                    self.sql.connection.execute('update wayta_requests set accessed=? where query=?', (time.time(), query))
+                    self.sql.connection.commit()
+                    return response.encode('utf-8')
+        except sqlite3.Error as e:
+            utils.debugging(e)
+
+    def set(self, query, response):
+        try:
+            now = time.time()
+            self.sql.connection.execute('insert or replace into wayta_requests (query, response, created, accessed) values (?, ?, ?, ?)', (query, response.decode('utf-8'), now, now))
+            total = self.sql.connection.execute('select count(*) from wayta_requests').fetchone()[0]
+            if total > WAYTA_CACHE_MAX_ITEMS:
+                self.sql.connection.execute('delete from wayta_requests where query in (select query from wayta_requests order by accessed limit ?)', (total - WAYTA_CACHE_MAX_ITEMS, ))
+            self.sql.connection.commit()
+        except (sqlite3.Error, UnicodeError) as e:
+            utils.debugging(e)
+
+
+def get_wayta_cache():
+    global wayta_cache
+    if wayta_cache is None:
+        wayta_cache = WaytaCache(curr_path + '/../tables/wayta.db')
+    return wayta_cache
+
+
 def wayta_request(text):
+    """
+    Returns the response of wayta to text, from the memory, from WaytaCache
+    or from wayta. WAYTA_OFFLINE=yes uses only the cache (expired or not)
+    Only one request of a text runs at a time, the other threads wait its response
+    """
+    if isinstance(text, unicode):
+        text = text.encode('utf-8')
+    query = ' '.join(text.split())
+
+    result = previous_requests.get(query)
+    if result is None:
+        result = get_wayta_cache().get(query, WAYTA_OFFLINE)
+        if result is not None:
+            previous_requests[query] = result
+    if result is None and not WAYTA_OFFLINE:
+        with wayta_requests_lock:
+            running = wayta_requests_running.get(query)
+            if running is None:
+                wayta_requests_running[query] = threading.Event()
+        if running is not None:
+            running.wait(WAYTA_TIMEOUT + 1)
+            result = previous_requests.get(query)
+        else:
+            try:
+                result = wayta_get(query)
+                if result is not None:
+                    previous_requests[query] = result
+                    get_wayta_cache().set(query, result)
+            finally:
+                with wayta_requests_lock:
+                    wayta_requests_running.pop(query).set()
+    if result is None:
+        result = []
+    return result
+
+
+def wayta_get(query):
     import urllib
     import urllib2
 
-    if isinstance(text, unicode):
-        text = text.encode('utf-8')
     result = None
     values = {
-                'q': text,
+                'q': query,
               }
-    url = 'http://wayta.scielo.org/api/v1/institution'
     try:
         data = urllib.urlencode(values)
-        full_url = url + '?' + data
-
-        result = previous_requests.get(full_url)
-        if result is None:
-            result = []
-        if len(result) == 0:
-            response = urllib2.urlopen(full_url, timeout=30)
-            result = response.read()
-            previous_requests[full_url] = result
-
+        full_url = WAYTA_URL + '?' + data
+        response = urllib2.urlopen(full_url, timeout=WAYTA_TIMEOUT)
+        result = response.read()
     except Exception as e:
         print(e)
-        result = []
     return result
 
 
@@ -237,7 +411,7 @@ def unicode2cp1252(results):
 
 def wayta_search(orgname, country, filter_country=None):
     results = []
-    for text in orgname.split(','):
+    for text in sorted(set(orgname.split(','))):
         try:
             if country is not None:
                 text += ',' + country
@@ -251,8 +425,15 @@ def wayta_search(orgname, country, filter_country=None):
     return results
 
 
+def get_org_manager():
+    global shared_org_manager
+    if shared_org_manager is None:
+        shared_org_manager = OrgManager()
+    return shared_org_manager
+
+
 def validate_organization(orgname, norgname, country_name, country_code, state, city):
-    org_manager = OrgManager()
+    org_manager = get_org_manager()
     normalized_results = []
     not_normalized_results = []
     if orgname is not None and norgname is not None:
@@ -296,7 +477,7 @@ def normaff_search(text):
     if '(' in country:
         country = country[0:country.find('(')].strip()
 
-    org_manager = OrgManager()
+    org_manager = get_org_manager()
     results = org_manager.search_institution_and_country_items(orgname, country, country)
 
     return results
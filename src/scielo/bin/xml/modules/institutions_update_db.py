@@ -20,8 +20,8 @@ deleted_report = curr_path + '/../tables/diff_deleted.txt'
 added_report = curr_path + '/../tables/diff_added.txt'
 
 
-def found_similar(text, items):
-    rate, similar_items = utils.most_similar(utils.similarity(items, text, min_ratio=0.96))
+def found_similar(text, items_index):
+    rate, similar_items = utils.most_similar(items_index.similarity(text, min_ratio=0.96))
 
     if len(similar_items) > 0:
         return similar_items[0]
@@ -88,6 +88,7 @@ def report_differences(old, new, deleted_report, added_report, fixed_report, rep
     print('=>')
     print([len(maybe_deleted), len(maybe_added)])
     organized_items = classify_items_by_len(maybe_added)
+    maybe_added_index = utils.SimilarityIndex(maybe_added)
 
     deleted = []
     replaced = []
@@ -99,7 +100,7 @@ def report_differences(old, new, deleted_report, added_report, fixed_report, rep
         if str(i).endswith('500') or str(i).endswith('000'):
             print(str(i) + total)
 
-        similar = found_similar(item, maybe_added)
+        similar = found_similar(item, maybe_added_index)
         if similar is None:
             similar = found_similar_2(item, organized_items.get(len(item), []))
         if similar is None:
@@ -81,6 +81,55 @@ def xml_transform(xml_filename, xsl_filename, result_filename, parameters={}):
     return (not error)
 
 
+def xml_transform_items(items, xsl_filename, parameters={}):
+    """
+    Transforms the items [(xml_filename, result_filename), ...] with the
+    same stylesheet, starting java and compiling the stylesheet only once
+    (saxon transforms all the files of the source directory)
+    The items which saxon can not transform are transformed one by one
+    Returns a list of bool: True if the result_filename was created
+    """
+    if len(items) < 2:
+        return [xml_transform(xml_filename, xsl_filename, result_filename, parameters) for xml_filename, result_filename in items]
+    register_log('xml_transform_items: inicio')
+    tmp_dir = tempfile.mkdtemp()
+    src_path = tmp_dir + '/src'
+    result_path = tmp_dir + '/result'
+    os.makedirs(src_path)
+    os.makedirs(result_path)
+
+    names = []
+    for i, item in enumerate(items):
+        xml_filename, result_filename = item
+        name = str(i) + '_' + os.path.basename(xml_filename)
+        shutil.copyfile(xml_filename, src_path + '/' + name)
+        names.append(name)
+        if not os.path.isdir(os.path.dirname(result_filename)):
+            os.makedirs(os.path.dirname(result_filename))
+        if os.path.isfile(result_filename):
+            os.unlink(result_filename)
+
+    cmd = JAVA_PATH + ' -jar "' + JAR_TRANSFORM + '" -novw -w0 -o "' + result_path + '" "' + src_path + '"  "' + xsl_filename + '" ' + format_parameters(parameters)
+    cmd = cmd.encode(encoding=sys.getfilesystemencoding())
+    os.system(cmd)
+
+    results = []
+    for name, item in zip(names, items):
+        xml_filename, result_filename = item
+        if os.path.isfile(result_path + '/' + name):
+            shutil.move(result_path + '/' + name, result_filename)
+            results.append(True)
+        else:
+            results.append(xml_transform(xml_filename, xsl_filename, result_filename, parameters))
+
+    try:
+        shutil.rmtree(tmp_dir)
+    except:
+        pass
+    register_log('xml_transform_items: fim')
+    return results
+
+
 def xml_validate(xml_filename, result_filename, doctype=None):
     register_log('xml_validate: inicio')
     validation_type = ''
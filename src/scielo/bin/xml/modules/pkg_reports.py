@@ -2,6 +2,7 @@
 
 import sys
 import os
+import multiprocessing
 from datetime import datetime
 
 from __init__ import _
@@ -16,6 +17,7 @@ import fs_utils
 
 
 log_items = []
+XML_VALIDATION_WORKERS = min(multiprocessing.cpu_count(), 4)
 
 
 class PackageValidationsResults(object):
@@ -794,8 +796,8 @@ class ArticlesPkgReport(object):
         utils.display_message('\n')
         utils.display_message(_('Validating XML files'))
         #utils.debugging('Validating package: inicio')
+        xml_names = []
         for xml_name in self.pkg_articles.xml_name_sorted_by_order:
-            doc = self.pkg_articles.articles[xml_name]
             doc_files_info = doc_files_info_items[xml_name]
             new_name = doc_files_info.new_name
 
@@ -804,27 +806,24 @@ class ArticlesPkgReport(object):
             utils.display_message(item_label)
 
             if xml_name in selected_names:
-                for f in [doc_files_info.dtd_report_filename, doc_files_info.style_report_filename, doc_files_info.data_report_filename, doc_files_info.pmc_style_report_filename]:
-                    if os.path.isfile(f):
-                        os.unlink(f)
-                xml_filename = doc_files_info.new_xml_filename
-
-                # XML structure validations
-                xml_f, xml_e, xml_w = validate_article_xml(xml_filename, dtd_files, doc_files_info.dtd_report_filename, doc_files_info.style_report_filename, doc_files_info.ctrl_filename, doc_files_info.err_filename)
-                report_content = ''
-                for rep_file in [doc_files_info.err_filename, doc_files_info.dtd_report_filename, doc_files_info.style_report_filename]:
-                    if os.path.isfile(rep_file):
-                        report_content += extract_report_core(fs_utils.read_file(rep_file))
-                        #if is_xml_generation is False:
-                        #    fs_utils.delete_file_or_folder(rep_file)
-                data_validations = ValidationsResults(report_content)
-                data_validations.fatal_errors = xml_f
-                data_validations.errors = xml_e
-                data_validations.warnings = xml_w
-                self.pkg_xml_structure_validations.add(xml_name, data_validations)
+                xml_names.append(xml_name)
             else:
                 utils.display_message(' -- not selected')
 
+        items = []
+        for xml_name in xml_names:
+            doc_files_info = doc_files_info_items[xml_name]
+            for f in [doc_files_info.dtd_report_filename, doc_files_info.style_report_filename, doc_files_info.data_report_filename, doc_files_info.pmc_style_report_filename]:
+                if os.path.isfile(f):
+                    os.unlink(f)
+            items.append((doc_files_info.new_xml_filename, doc_files_info.dtd_report_filename, doc_files_info.style_report_filename))
+
+        # each validation runs java in other process, so threads are enough
+        # to validate the files at the same time
+        results = xpchecker.validate_articles_xml(items, dtd_files, XML_VALIDATION_WORKERS)
+        for xml_name, result in zip(xml_names, results):
+            self.pkg_xml_structure_validations.add(xml_name, xml_structure_validations(doc_files_info_items[xml_name], result))
+
     def validate_articles_pkg_xml_content(self, doc_files_info_items, pkg_path, new_names, is_xml_generation, selected_names=None):
         if selected_names is None:
             selected_names = self.pkg_articles.articles.keys()
@@ -940,9 +939,26 @@ def delete_irrelevant_reports(ctrl_filename, is_valid_style, dtd_validation_repo
         os.unlink(dtd_validation_report)
 
 
+def xml_structure_validations(doc_files_info, validation_result):
+    xml_f, xml_e, xml_w = article_xml_validations_stats(validation_result, doc_files_info.dtd_report_filename, doc_files_info.style_report_filename, doc_files_info.ctrl_filename, doc_files_info.err_filename)
+    report_content = ''
+    for rep_file in [doc_files_info.err_filename, doc_files_info.dtd_report_filename, doc_files_info.style_report_filename]:
+        if os.path.isfile(rep_file):
+            report_content += extract_report_core(fs_utils.read_file(rep_file))
+    data_validations = ValidationsResults(report_content)
+    data_validations.fatal_errors = xml_f
+    data_validations.errors = xml_e
+    data_validations.warnings = xml_w
+    return data_validations
+
+
 def validate_article_xml(xml_filename, dtd_files, dtd_report, style_report, ctrl_filename, err_filename):
+    validation_result = xpchecker.validate_article_xml(xml_filename, dtd_files, dtd_report, style_report)
+    return article_xml_validations_stats(validation_result, dtd_report, style_report, ctrl_filename, err_filename)
+
 
-    xml, valid_dtd, valid_style = xpchecker.validate_article_xml(xml_filename, dtd_files, dtd_report, style_report)
+def article_xml_validations_stats(validation_result, dtd_report, style_report, ctrl_filename, err_filename):
+    xml, valid_dtd, valid_style = validation_result
     f, e, w = valid_style
     update_err_filename(err_filename, dtd_report)
     if xml is None:
@@ -1,6 +1,8 @@
 # coding=utf-8
 import os
 import shutil
+import hashlib
+import json
 from datetime import datetime
 
 import fs_utils
@@ -63,6 +65,81 @@ def delete_files(files):
                 os.unlink(f)
 
 
+def file_hash(filename):
+    h = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), ''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def publish_file(src, dest):
+    """
+    Copies src to dest, keeping its mtime, unless dest has the same content
+    (same size and same mtime or hash)
+    Returns True if dest was created or replaced
+    """
+    if os.path.isfile(dest):
+        src_stat = os.stat(src)
+        dest_stat = os.stat(dest)
+        if src_stat.st_size == dest_stat.st_size:
+            if int(src_stat.st_mtime) == int(dest_stat.st_mtime) or file_hash(src) == file_hash(dest):
+                return False
+        os.unlink(dest)
+    shutil.copy2(src, dest)
+    return True
+
+
+def articles_files_hashes(path, xml_names):
+    """
+    Returns {xml_name: {filename: hash}}, for the XML file and the related
+    files (xml_name.* and xml_name-*) of each article in path
+    """
+    hashes = {xml_name: {} for xml_name in xml_names}
+    for f in os.listdir(path):
+        # the longest xml_name, if f is related to more than one article
+        names = [f[0:i] for i in range(0, len(f)) if f[i] in '.-' and f[0:i] in hashes]
+        if len(names) > 0 and os.path.isfile(path + '/' + f):
+            hashes[names[-1]][f] = file_hash(path + '/' + f)
+    return hashes
+
+
+class ArticlesManifest(object):
+    """
+    Hashes of the files of the registered articles of an issue, from
+    articles_files_hashes, saved in base_xml/manifest.json
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._items = None
+
+    @property
+    def items(self):
+        if self._items is None:
+            self._items = {}
+            if os.path.isfile(self.filename):
+                try:
+                    self._items = json.loads(open(self.filename, 'r').read())
+                except ValueError:
+                    pass
+        return self._items
+
+    def get(self, xml_name):
+        return self.items.get(xml_name)
+
+    def save(self, items, registered_names):
+        """
+        Updates the hashes of items and removes the articles which are not registered
+        """
+        self.items.update(items)
+        self._items = {xml_name: hashes for xml_name, hashes in self.items.items() if xml_name in registered_names}
+        open(self.filename + '.tmp', 'w').write(json.dumps(self._items, sort_keys=True))
+        if os.path.isfile(self.filename):
+            os.unlink(self.filename)
+        os.rename(self.filename + '.tmp', self.filename)
+
+
 class ArticleFiles(object):
 
     def __init__(self, issue_files, order, xml_name):
@@ -142,6 +219,10 @@ class IssueFiles(object):
     def id_filename(self):
         return self.id_path + '/i.id'
 
+    @property
+    def manifest_filename(self):
+        return self.issue_path + '/base_xml/manifest.json'
+
     @property
     def base_path(self):
         return self.issue_path + '/base'
@@ -178,7 +259,16 @@ class IssueFiles(object):
     def windows_base(self):
         return self.windows_base_path + '/' + self.issue_folder
 
+    @property
+    def web_app_changes_filename(self):
+        return self.issue_path + '/base_xml/web_app_changes.txt'
+
     def copy_files_to_local_web_app(self):
+        """
+        Publishes the files of xml_path in the local web app, skipping the
+        unchanged ones (publish_file)
+        The published files (relative to web_path) are listed in web_app_changes_filename
+        """
         msg = ['\n']
         msg.append('copying files from ' + self.xml_path)
         print('copy_files_to_local_web_app')
@@ -186,35 +276,44 @@ class IssueFiles(object):
         path = {}
         path['pdf'] = self.web_path + '/bases/pdf/' + self.relative_issue_path
         path['xml'] = self.web_path + '/bases/xml/' + self.relative_issue_path
-        path['html'] = self.web_path + '/htdocs/img/revistas/' + self.relative_issue_path + '/html/'
+        path['html'] = self.web_path + '/htdocs/img/revistas/' + self.relative_issue_path + '/html'
         path['img'] = self.web_path + '/htdocs/img/revistas/' + self.relative_issue_path
-        xml_files = [f for f in os.listdir(self.xml_path) if f.endswith('.xml') and not f.endswith('.rep.xml')]
-        xml_content = ''.join([fs_utils.read_file(self.xml_path + '/' + xml_filename) for xml_filename in os.listdir(self.xml_path) if xml_filename.endswith('.xml')])
+        files = os.listdir(self.xml_path)
+        xml_files = [f for f in files if f.endswith('.xml') and not f.endswith('.rep.xml')]
+        xml_content = None
 
         for p in path.values():
             if not os.path.isdir(p):
                 os.makedirs(p)
-        for f in os.listdir(self.xml_path):
+        changes = []
+        unchanged = 0
+        for f in files:
             if f.endswith('.xml.bkp') or f.endswith('.xml.replaced.txt') or f.endswith('.rep.xml'):
                 pass
             elif os.path.isfile(self.xml_path + '/' + f):
                 ext = f[f.rfind('.')+1:]
 
+                dest = None
                 if path.get(ext) is None:
                     if not f.endswith('.tif') and not f.endswith('.tiff'):
-                        shutil.copy(self.xml_path + '/' + f, path['img'])
-                        msg.append('  ' + f + ' => ' + path['img'])
+                        dest = path['img'] + '/' + f
                 elif ext == 'pdf':
                     pdf_filename = f
                     if not pdf_filename.replace('.pdf', '.xml') in xml_files:
+                        if xml_content is None:
+                            xml_content = ''.join([fs_utils.read_file(self.xml_path + '/' + xml_filename) for xml_filename in files if xml_filename.endswith('.xml')])
                         pdf_filename = self.fix_pdf_name(f, xml_content)
-                    if os.path.isfile(path[ext] + '/' + pdf_filename):
-                        os.unlink(path[ext] + '/' + pdf_filename)
-                    shutil.copyfile(self.xml_path + '/' + f, path[ext] + '/' + pdf_filename)
-                    msg.append('  ' + f + ' => ' + path[ext] + '/' + pdf_filename)
+                    dest = path[ext] + '/' + pdf_filename
                 else:
-                    shutil.copy(self.xml_path + '/' + f, path[ext])
-                    msg.append('  ' + f + ' => ' + path[ext])
+                    dest = path[ext] + '/' + f
+                if dest is not None:
+                    if publish_file(self.xml_path + '/' + f, dest):
+                        changes.append(dest[len(self.web_path)+1:])
+                        msg.append('  ' + f + ' => ' + dest)
+                    else:
+                        unchanged += 1
+        msg.append('  ' + str(unchanged) + ' unchanged files')
+        fs_utils.write_file(self.web_app_changes_filename, '\n'.join(changes))
         return '\n'.join(['<p>' + item + '</p>' for item in msg])
 
     def fix_pdf_name(self, filename, xml_content):
@@ -252,7 +351,7 @@ class IssueFiles(object):
                     pass
                 elif f.endswith('.xml'):
                     try:
-                        shutil.copy(xml_path + '/' + f, self.base_source_path)
+                        publish_file(xml_path + '/' + f, self.base_source_path + '/' + f)
                     except:
                         pass
 
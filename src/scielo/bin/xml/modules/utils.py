@@ -1,5 +1,6 @@
 # coding=utf-8
 
+from collections import Counter
 from datetime import datetime
 
 IMDEBUGGING = False
@@ -38,14 +39,64 @@ def how_similar(this, that):
 
 
 def similarity(items, text, min_ratio=0):
-    r = {}
-    for item in items:
-        rate = how_similar(item, text)
-        if rate > min_ratio:
-            if not rate in r.keys():
-                r[rate] = []
-            r[rate].append(item)
-    return r
+    return SimilarityIndex(items).similarity(text, min_ratio)
+
+
+class SimilarityIndex(object):
+    """
+    Vocabulary prepared to be compared to many texts, with the same results
+    of how_similar (difflib ratio of the lower case texts)
+
+    The items are grouped by length and have their characters counted, so
+    the items which can not reach min_ratio are discarded by the upper
+    bounds of the ratio (real_quick_ratio and quick_ratio of difflib)
+    before the ratio is calculated
+    """
+
+    def __init__(self, items):
+        self.items = []
+        self.by_length = {}
+        for item in items:
+            normalized = (item if item is not None else 'None').lower()
+            self.by_length.setdefault(len(normalized), []).append(len(self.items))
+            self.items.append((item, normalized, Counter(normalized)))
+
+    def candidates(self, text, min_ratio):
+        """
+        Returns the positions of the items whose length allows a ratio > min_ratio
+        """
+        positions = []
+        for length, items in self.by_length.items():
+            total = length + len(text)
+            if total == 0 or 2.0 * min(length, len(text)) / total > min_ratio:
+                positions.extend(items)
+        return sorted(positions)
+
+    def similarity(self, text, min_ratio=0):
+        """
+        Returns the same of similarity(items, text, min_ratio):
+        {rate: [items which have rate]} for rate > min_ratio
+        """
+        import difflib
+        text = (text if text is not None else 'None').lower()
+        text_chars = Counter(text)
+        matcher = difflib.SequenceMatcher(None)
+        matcher.set_seq2(text)
+        r = {}
+        for position in self.candidates(text, min_ratio):
+            item, normalized, chars = self.items[position]
+            total = len(normalized) + len(text)
+            if total > 0:
+                matches = sum([min(count, text_chars[c]) for c, count in chars.items()])
+                if 2.0 * matches / total <= min_ratio:
+                    continue
+            matcher.set_seq1(normalized)
+            rate = matcher.ratio()
+            if rate > min_ratio:
+                if not rate in r.keys():
+                    r[rate] = []
+                r[rate].append(item)
+        return r
 
 
 def most_similar(similarity):
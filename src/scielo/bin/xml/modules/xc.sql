@@ -1,7 +1,10 @@
-create table institutions (
+create table if not exists institutions (
     name     text,
     city        text,
     state       text,
     country_code text,
     country_name     text
 );
+create index if not exists institutions_name on institutions (name);
+create index if not exists institutions_country_code on institutions (country_code);
+create index if not exists institutions_country_name on institutions (country_name);
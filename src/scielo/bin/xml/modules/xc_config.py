@@ -1,12 +1,24 @@
 # coding=utf-8
 import os
 import shutil
+import multiprocessing
 
 
 CURRENT_PATH = os.path.dirname(os.path.realpath(__file__)).replace('\\', '/')
 CONFIG_PATH = CURRENT_PATH + '/../config/'
 
 
+def number_of_workers(value, default):
+    """
+    value: positive number or 'auto' (number of CPUs)
+    """
+    if value == 'auto':
+        return multiprocessing.cpu_count()
+    if value is not None and value.isdigit() and int(value) > 0:
+        return int(value)
+    return default
+
+
 class XMLConverterConfiguration(object):
 
     def __init__(self, filename):
@@ -92,6 +104,26 @@ class XMLConverterConfiguration(object):
     def max_warning(self):
         return self._data.get('MAX_WARNING')
 
+    @property
+    def conversion_workers(self):
+        return number_of_workers(self._data.get('CONVERSION_WORKERS'), 1)
+
+    @property
+    def package_workers(self):
+        return number_of_workers(self._data.get('PACKAGE_WORKERS'), 1)
+
+    @property
+    def package_queue_size(self):
+        return number_of_workers(self._data.get('PACKAGE_QUEUE_SIZE'), 2 * self.package_workers)
+
+    @property
+    def max_validations(self):
+        return number_of_workers(self._data.get('MAX_VALIDATIONS'), self.package_workers)
+
+    @property
+    def max_transfers(self):
+        return number_of_workers(self._data.get('MAX_TRANSFERS'), self.package_workers)
+
     def update_title_and_issue(self):
         for item in [self._data.get('SOURCE_TITLE_DB'), self._data.get('SOURCE_ISSUE_DB')]:
             for ext in ['.mst', '.xrf']:
@@ -9,6 +9,7 @@ import validation_status
 import utils
 import xml_utils
 import fs_utils
+import dbm_sql
 from utils import how_similar
 from article import Issue, PersonAuthor, Article
 from attributes import ROLE, DOCTOPIC, doctopic_label
@@ -512,6 +513,7 @@ class IssueModels(object):
     def __init__(self, record):
         self.record = record
         self._issue = None
+        self._section_titles_index = None
 
     @property
     def sections(self):
@@ -525,8 +527,9 @@ class IssueModels(object):
         return [sec.get('t') for sec in self.sections]
 
     def most_similar_section_code(self, section_title, acceptable_result=0.85):
-        items = [sec.get('t', '') for sec in self.sections]
-        most_similar = utils.similarity(items, section_title, acceptable_result)
+        if self._section_titles_index is None:
+            self._section_titles_index = utils.SimilarityIndex([sec.get('t', '') for sec in self.sections])
+        most_similar = self._section_titles_index.similarity(section_title, acceptable_result)
         ratio, similar_list = utils.most_similar(most_similar)
         seccode = None
         similar = None
@@ -737,8 +740,9 @@ class ArticleDB(object):
         self._registration_reports = None
 
     def restore_missing_id_files(self):
-        if self.registered_articles.items() is not None:
-            for name, registered_article in self.registered_articles.items():
+        i_record, registered_articles_records = self.registered_records
+        if registered_articles_records is not None:
+            for name, registered_article in registered_articles_records.items():
                 article_files = serial_files.ArticleFiles(self.issue_files, registered_article.order, registered_article.xml_name)
                 if not os.path.isfile(article_files.id_filename):
                     self.db_isis.save_id(article_files.id_filename, registered_article.article_records)
@@ -818,12 +822,13 @@ class ArticleDB(object):
 
     def create_db(self):
         if os.path.isfile(self.issue_files.id_filename):
-            self.db_isis.save_id_records(self.issue_files.id_filename, self.issue_files.base)
-            for f in os.listdir(self.issue_files.id_path):
+            id_files = [self.issue_files.id_filename]
+            for f in sorted(os.listdir(self.issue_files.id_path)):
                 if f == '00000.id':
                     os.unlink(self.issue_files.id_path + '/' + f)
                 if f.endswith('.id') and f != '00000.id' and f != 'i.id':
-                    self.db_isis.append_id_records(self.issue_files.id_path + '/' + f, self.issue_files.base)
+                    id_files.append(self.issue_files.id_path + '/' + f)
+            self.db_isis.update_id_files(id_files, self.issue_files.base)
         self.reset_registered_records()
 
     def article_records(self, i_record, article, article_files):
@@ -835,13 +840,16 @@ class ArticleDB(object):
     def create_issue_id_file(self, i_record):
         self.db_isis.save_id(self.issue_files.id_filename, [i_record])
 
+    def create_id_paths(self):
+        if not os.path.isdir(self.issue_files.id_path):
+            os.makedirs(self.issue_files.id_path)
+        if not os.path.isdir(self.issue_files.base_path):
+            os.makedirs(self.issue_files.base_path)
+
     def create_article_id_file(self, article_records, article_files):
         saved = False
         previous = False
-        if not os.path.isdir(article_files.issue_files.id_path):
-            os.makedirs(article_files.issue_files.id_path)
-        if not os.path.isdir(article_files.issue_files.base_path):
-            os.makedirs(article_files.issue_files.base_path)
+        self.create_id_paths()
 
         if article_records is not None:
             if os.path.isfile(article_files.id_filename):
@@ -856,12 +864,22 @@ class ArticleDB(object):
         return saved and not previous
 
     def evaluate(self, i_record, article, valid_aop, incorrect_order):
+        id_created = self.create_id_file(i_record, article)
+        self.register_evaluation(article, id_created, valid_aop, incorrect_order)
+
+    def create_id_file(self, i_record, article):
+        """
+        Creates the article .id file
+        It does not change the state of ArticleDB, so it can run in other process
+        """
+        article_files = serial_files.ArticleFiles(self.issue_files, article.order, article.xml_name)
+        article_records = self.article_records(i_record, article, article_files)
+        return self.create_article_id_file(article_records, article_files)
+
+    def register_evaluation(self, article, id_created, valid_aop, incorrect_order):
         is_excluded_incorrect_order = None
         is_excluded_aop = None
         is_excluded_aop_msg = None
-        article_files = serial_files.ArticleFiles(self.issue_files, article.order, article.xml_name)
-        article_records = self.article_records(i_record, article, article_files)
-        id_created = self.create_article_id_file(article_records, article_files)
         validations = []
         validations.append(id_created)
         if id_created:
@@ -956,6 +974,118 @@ class ArticleDB(object):
         self.db_isis.cisis.crunchmf(self.issue_files.base, self.issue_files.windows_base)
 
 
+class IndexedAop(object):
+    """
+    Data of a registered aop, stored in AopIndex
+    The XML file is loaded only if body_words is required
+    """
+
+    def __init__(self, db_name, xml_name, doi, pid, order, filename, issue_label, title, first_author_surname, xml_filename):
+        self.db_name = db_name
+        self.xml_name = xml_name
+        self.doi = doi
+        self.pid = pid
+        self.order = order
+        self.filename = filename
+        self.issue_label = issue_label
+        self.title = title
+        self.first_author_surname = first_author_surname
+        self.xml_filename = xml_filename
+        self._body_words = None
+
+    @property
+    def body_words(self):
+        if self._body_words is None and os.path.isfile(self.xml_filename):
+            xml, e = xml_utils.load_xml(self.xml_filename)
+            self._body_words = Article(xml, self.xml_name).body_words
+        return self._body_words
+
+    def short_article_title(self, size=None):
+        if size is None or not size.isdigit() or self.title is None:
+            return self.title
+        return self.title[0:size] + '...' if len(self.title) > size else self.title
+
+
+class AopIndex(object):
+    """
+    Persistent index of the aop articles of a journal (aop_index.db, in the journal folder)
+    An aop base is indexed again only if it changed, and only the XML files
+    which changed are loaded
+    """
+
+    def __init__(self, db_filename):
+        self.sql = dbm_sql.SQL(db_filename)
+        self.sql.execute_script('create table if not exists aop_bases (db_name text primary key, signature text); create table if not exists aop_articles (db_name text, xml_name text, doi text, pid text, article_order text, filename text, issue_label text, title text, first_author_surname text, xml_signature text, primary key (db_name, xml_name));')
+
+    def file_signature(self, filename):
+        if os.path.isfile(filename):
+            return str(os.path.getmtime(filename)) + ' ' + str(os.path.getsize(filename))
+        return ''
+
+    def text(self, value):
+        if value is not None and not isinstance(value, unicode):
+            value = value.decode('utf-8')
+        return value
+
+    def articles(self, db_name, issue_files):
+        items = []
+        for row in self.sql.query('select xml_name, doi, pid, article_order, filename, issue_label, title, first_author_surname from aop_articles where db_name=? order by article_order', (db_name, )):
+            xml_name, doi, pid, order, filename, issue_label, title, first_author_surname = row
+            items.append(IndexedAop(db_name, xml_name, doi, pid, order, filename, issue_label, title, first_author_surname, issue_files.base_source_path + '/' + xml_name + '.xml'))
+        return items
+
+    def missing_id_files(self, db_name, issue_files):
+        for row in self.sql.query('select xml_name, article_order from aop_articles where db_name=?', (db_name, )):
+            if not os.path.isfile(serial_files.ArticleFiles(issue_files, row[1], row[0]).id_filename):
+                return True
+        return False
+
+    def update(self, db_name, aop_db):
+        """
+        Updates the index of db_name, if aop_db was changed or some .id file is missing
+        """
+        issue_files = aop_db.issue_files
+        signature = self.file_signature(issue_files.base + '.mst')
+        row = self.sql.query_one('select signature from aop_bases where db_name=?', (db_name, ))
+        is_updated = row is not None and row[0] == signature
+        if is_updated and not self.missing_id_files(db_name, issue_files):
+            return
+        aop_db.restore_missing_id_files()
+        if is_updated:
+            return
+
+        indexed = {}
+        for row in self.sql.query('select xml_name, pid, article_order, filename, xml_signature, doi, issue_label, title, first_author_surname from aop_articles where db_name=?', (db_name, )):
+            indexed[row[0]] = row
+        rows = []
+        i_record, registered_articles_records = aop_db.registered_records
+        for xml_name, registered_article in registered_articles_records.items():
+            xml_filename = issue_files.base_source_path + '/' + xml_name + '.xml'
+            key = (self.text(xml_name), self.text(registered_article.pid), self.text(registered_article.order), self.text(xml_name + '.xml'), self.file_signature(xml_filename))
+            row = indexed.get(key[0])
+            if row is None or tuple(row[0:5]) != key:
+                xml = None
+                if os.path.isfile(xml_filename):
+                    xml, e = xml_utils.load_xml(xml_filename)
+                doc = Article(xml, xml_name)
+                row = key + (self.text(doc.doi), self.text(doc.issue_label), self.text(doc.title), self.text(doc.first_author_surname))
+            rows.append((db_name, ) + tuple(row))
+
+        conn = self.sql.connection
+        conn.execute('delete from aop_articles where db_name=?', (db_name, ))
+        conn.executemany('insert into aop_articles (db_name, xml_name, pid, article_order, filename, xml_signature, doi, issue_label, title, first_author_surname) values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+        conn.execute('insert or replace into aop_bases (db_name, signature) values (?, ?)', (db_name, signature))
+        conn.commit()
+
+    def remove_other_bases(self, db_names):
+        conn = self.sql.connection
+        for row in self.sql.query('select db_name from aop_bases'):
+            if not row[0] in db_names:
+                conn.execute('delete from aop_articles where db_name=?', (row[0], ))
+                conn.execute('delete from aop_bases where db_name=?', (row[0], ))
+        conn.commit()
+
+
 class AopManager(object):
 
     def __init__(self, db_isis, journal_files):
@@ -982,18 +1112,23 @@ class AopManager(object):
 
     def setup(self):
         self._aop_db_items = {}
-        for name, aop_issue_files in self.journal_files.aop_issue_files.items():
+        aop_issue_files_items = self.journal_files.aop_issue_files.items()
+        if len(aop_issue_files_items) == 0:
+            return
+        aop_index = AopIndex(self.journal_files.journal_path + '/aop_index.db')
+        for name, aop_issue_files in aop_issue_files_items:
             self._aop_db_items[aop_issue_files.issue_folder] = ArticleDB(self.db_isis, aop_issue_files)
-            self._aop_db_items[aop_issue_files.issue_folder].restore_missing_id_files()
-
-            if self._aop_db_items[aop_issue_files.issue_folder].registered_articles is not None:
-                for xml_name, registered_aop in self._aop_db_items[aop_issue_files.issue_folder].registered_articles.items():
-                    self.indexed_by_doi[registered_aop.doi] = registered_aop.xml_name
-                    self.indexed_by_xml_name[registered_aop.xml_name] = registered_aop
-                    if self.still_aop.get(aop_issue_files.issue_folder) is None:
-                        self.still_aop[aop_issue_files.issue_folder] = {}
-                    self.still_aop[aop_issue_files.issue_folder][registered_aop.order] = registered_aop.xml_name
-                    self.db_names[xml_name] = aop_issue_files.issue_folder
+            aop_index.update(aop_issue_files.issue_folder, self._aop_db_items[aop_issue_files.issue_folder])
+
+            for registered_aop in aop_index.articles(aop_issue_files.issue_folder, aop_issue_files):
+                self.indexed_by_doi[registered_aop.doi] = registered_aop.xml_name
+                self.indexed_by_xml_name[registered_aop.xml_name] = registered_aop
+                if self.still_aop.get(aop_issue_files.issue_folder) is None:
+                    self.still_aop[aop_issue_files.issue_folder] = {}
+                self.still_aop[aop_issue_files.issue_folder][registered_aop.order] = registered_aop.xml_name
+                self.db_names[registered_aop.xml_name] = aop_issue_files.issue_folder
+        aop_index.remove_other_bases(self._aop_db_items.keys())
+        aop_index.sql.close()
 
     @property
     def aop_db_items(self):
@@ -1025,6 +1160,21 @@ class AopManager(object):
             aop = self.indexed_by_xml_name.get(filename)
         return aop
 
+    def is_affected_by_ex_aop(self, article, ex_aop_items):
+        """
+        Returns True if the result of check_aop(article) may change after
+        the exclusion of ex_aop_items (manage_ex_aop)
+        """
+        if len(ex_aop_items) == 0 or not self.journal_has_aop():
+            return False
+        ex_aop_names = [aop.xml_name for aop in ex_aop_items]
+        if article.doi is not None and article.doi in [aop.doi for aop in ex_aop_items]:
+            return True
+        if len([xml_name for xml_name in self.indexed_by_xml_name.keys() if not xml_name in ex_aop_names]) == 0:
+            return True
+        aop = self.find_aop(article.doi, article.xml_name)
+        return aop is not None and aop.xml_name in ex_aop_names
+
     def aop_article(self, xml_name):
         return self.aop_info.get(xml_name, [None, None])[0]
 
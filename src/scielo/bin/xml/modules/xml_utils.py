@@ -1,9 +1,13 @@
 # coding=utf-8
 import os
+import re
+import atexit
 import shutil
 import tempfile
+import multiprocessing
 import xml.etree.ElementTree as etree
 import HTMLParser
+import htmlentitydefs
 from StringIO import StringIO
 
 from __init__ import _
@@ -11,6 +15,17 @@ import fs_utils
 
 
 ENTITIES_TABLE = None
+NAMED_ENTITIES_CHARS = None
+
+# "&name;", the entities are resolved in one scan of the text
+ENTITY = re.compile(r'&([^&;]*);')
+# names which HTMLParser.unescape resolves
+HTML_ENTITY_NAME = re.compile(r'#?[xX]?(?:[0-9a-fA-F]+|\w{1,8})\Z')
+XML_ENTITIES = {38: u'&amp;', 60: u'&lt;', 62: u'&gt;'}
+
+# named entities which are not converted, saved in named_entities.txt at exit
+remaining_named_entities = set()
+remaining_named_entities_filename = None
 
 etree.register_namespace('mml', 'http://www.w3.org/1998/Math/MathML')
 etree.register_namespace('xlink', 'http://www.w3.org/1999/xlink')
@@ -211,73 +226,63 @@ def tostring(node):
     return etree.tostring(node)
 
 
-def preserve_xml_entities(content):
-    if '&' in content:
-        content = content.replace('&#x0003C;', '<REPLACEENT>lt</REPLACEENT>')
-        content = content.replace('&#x0003E;', '<REPLACEENT>gt</REPLACEENT>')
-        content = content.replace('&#x00026;', '<REPLACEENT>amp</REPLACEENT>')
-        content = content.replace('&#x003C;', '<REPLACEENT>lt</REPLACEENT>')
-        content = content.replace('&#x003E;', '<REPLACEENT>gt</REPLACEENT>')
-        content = content.replace('&#x0026;', '<REPLACEENT>amp</REPLACEENT>')
-        content = content.replace('&#x03C;', '<REPLACEENT>lt</REPLACEENT>')
-        content = content.replace('&#x03E;', '<REPLACEENT>gt</REPLACEENT>')
-        content = content.replace('&#x026;', '<REPLACEENT>amp</REPLACEENT>')
-        content = content.replace('&#x3C;', '<REPLACEENT>lt</REPLACEENT>')
-        content = content.replace('&#x3E;', '<REPLACEENT>gt</REPLACEENT>')
-        content = content.replace('&#x26;', '<REPLACEENT>amp</REPLACEENT>')
-
-        content = content.replace('&#60;', '<REPLACEENT>lt</REPLACEENT>')
-        content = content.replace('&#62;', '<REPLACEENT>gt</REPLACEENT>')
-        content = content.replace('&#38;', '<REPLACEENT>amp</REPLACEENT>')
-        content = content.replace('&lt;', '<REPLACEENT>lt</REPLACEENT>')
-        content = content.replace('&gt;', '<REPLACEENT>gt</REPLACEENT>')
-        content = content.replace('&amp;', '<REPLACEENT>amp</REPLACEENT>')
-    return content
+def load_named_entities_chars():
+    """
+    Returns {name: (char, is_from_entities_table)}
+    The names known by HTMLParser.unescape have precedence over the entities table
+    """
+    global ENTITIES_TABLE
+    if ENTITIES_TABLE is None:
+        ENTITIES_TABLE = load_entities_table()
+    chars = {}
+    for ent, char in ENTITIES_TABLE.items():
+        if ent.startswith('&') and ent.endswith(';'):
+            chars[ent[1:-1].decode('utf-8')] = (char.decode('utf-8'), True)
+    chars[u'mldr'] = (u"\u2026", False)
+    for name, codepoint in htmlentitydefs.name2codepoint.items():
+        chars[name.decode('utf-8')] = (unichr(codepoint), False)
+    chars[u'apos'] = (u"'", False)
+    for codepoint, ent in XML_ENTITIES.items():
+        chars[ent[1:-1]] = (ent, False)
+    return chars
+
+
+def numeric_entity_char(name):
+    """
+    Returns the char of name (#999 or #xHHH), or None
+    &lt;, &gt; and &amp; are kept as entities
+    """
+    if HTML_ENTITY_NAME.match(name) is not None:
+        try:
+            if name[1:2] in ['x', 'X']:
+                codepoint = int(name[2:], 16)
+            else:
+                codepoint = int(name[1:])
+            return XML_ENTITIES.get(codepoint) or unichr(codepoint)
+        except (ValueError, OverflowError):
+            pass
 
 
-def named_ent_to_char(content):
-    replaced_named_ent = []
+def register_remaining_named_entities(entities):
+    global remaining_named_entities_filename
+    if remaining_named_entities_filename is None:
+        remaining_named_entities_filename = os.path.abspath('./named_entities.txt')
+    remaining_named_entities.update(entities)
+    if multiprocessing.current_process().daemon:
+        # worker processes do not run atexit
+        save_remaining_named_entities()
 
-    if '&' in content:
-        text = content.replace('&', '_BREAK_&').replace(';', ';_BREAK_')
-        entities = list(set([item for item in text.split('_BREAK_') if item.startswith('&') and item.endswith(';')]))
-        if len(entities) > 0:
-            global ENTITIES_TABLE
-
-            if ENTITIES_TABLE is None:
-                ENTITIES_TABLE = load_entities_table()
-            if ENTITIES_TABLE is not None:
-                for ent in entities:
-                    new = ENTITIES_TABLE.get(ent, ent)
-                    if not isinstance(new, unicode):
-                        new = new.decode('utf-8')
-                    if not isinstance(ent, unicode):
-                        ent = ent.decode('utf-8')
-                    #print(type(new))
-                    #print(type(ent))
-                    #print(new)
-                    #print(ent)
-                    if new != ent:
-                        replaced_named_ent.append(ent + '=>' + new)
-                        content = content.replace(ent, new)
-    return (content, replaced_named_ent)
-
-
-def register_remaining_named_entities(content):
-    if '&' in content:
-        entities = []
-        if os.path.isfile('./named_entities.txt'):
-            entities = open('./named_entities.txt', 'r').read()
-            entities = entities.decode('utf-8').split('\n')
-        content = content[content.find('&'):]
-        l = content.split('&')
-        for item in l:
-            if not item.startswith('#') and ';' in item:
-                ent = item[0:item.find(';')]
-                entities.append('&' + ent + ';')
-        entities = sorted(list(set(entities)))
-        if len(entities) > 0:
-            open('./named_entities.txt', 'w').write('\n'.join(entities).encode('utf-8'))
+
+def save_remaining_named_entities():
+    if len(remaining_named_entities) > 0:
+        entities = set(remaining_named_entities)
+        if os.path.isfile(remaining_named_entities_filename):
+            entities.update(open(remaining_named_entities_filename, 'r').read().decode('utf-8').split('\n'))
+        open(remaining_named_entities_filename, 'w').write('\n'.join(sorted(entities)).encode('utf-8'))
+        remaining_named_entities.clear()
+
+
+atexit.register(save_remaining_named_entities)
 
 
 def htmlent2char(content):
@@ -313,25 +318,41 @@ def htmlent2char(content):
     return content
 
 
-def restore_xml_entities(content):
-    if '<REPLACEENT>' in content:
-        content = content.replace('<REPLACEENT>gt</REPLACEENT>', '&gt;')
-        content = content.replace('<REPLACEENT>lt</REPLACEENT>', '&lt;')
-        content = content.replace('<REPLACEENT>amp</REPLACEENT>', '&amp;')
-    return content
-
-
 def convert_entities_to_chars(content, debug=False):
+    """
+    Converts the named and numeric entities to chars, in one scan of content,
+    except &lt;, &gt; and &amp; (and their numeric entities)
+    Returns (content, ['&name;=>char', ...]), which has the names converted
+    by the entities table
+    """
     replaced_named_ent = []
     if '&' in content:
-        content = preserve_xml_entities(content)
-        content = htmlent2char(content)
-        content = content.replace('&mldr;', u"\u2026")
-        content, replaced_named_ent = named_ent_to_char(content)
-
-        register_remaining_named_entities(content)
+        global NAMED_ENTITIES_CHARS
+        if NAMED_ENTITIES_CHARS is None:
+            NAMED_ENTITIES_CHARS = load_named_entities_chars()
+        if not isinstance(content, unicode):
+            content = content.decode('utf-8')
 
-        content = restore_xml_entities(content)
+        remaining = set()
+        replaced = set()
+
+        def entity_char(match):
+            name = match.group(1)
+            if name.startswith('#'):
+                char = numeric_entity_char(name)
+                return match.group(0) if char is None else char
+            char, is_from_entities_table = NAMED_ENTITIES_CHARS.get(name, (None, False))
+            if char is None:
+                remaining.add(match.group(0))
+                return match.group(0)
+            if is_from_entities_table and not name in replaced:
+                replaced.add(name)
+                replaced_named_ent.append(match.group(0) + '=>' + char)
+            return char
+
+        content = ENTITY.sub(entity_char, content)
+        if len(remaining) > 0:
+            register_remaining_named_entities(remaining)
     return content, replaced_named_ent
 
 
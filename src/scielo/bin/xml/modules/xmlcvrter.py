@@ -2,6 +2,8 @@
 
 import os
 import shutil
+import multiprocessing
+import zlib
 from datetime import datetime
 
 from __init__ import _
@@ -12,6 +14,7 @@ import article_utils
 import html_reports
 import dbm_isis
 import xc_models
+import serial_files
 import pkg_reports
 import xml_utils
 import xml_versions
@@ -25,6 +28,8 @@ CURRENT_PATH = os.path.dirname(os.path.realpath(__file__)).replace('\\', '/')
 
 CONFIG_PATH = CURRENT_PATH + '/../config/'
 converter_env = None
+pending_conversion = None
+JOURNAL_LOCKS = 64
 
 
 categories_messages = {
@@ -62,6 +67,76 @@ class ConverterEnv(object):
         self.serial_path = None
         self.is_windows = None
         self.db_manager = None
+        self.conversion_workers = 1
+        self.scheduler = None
+
+
+class PackageScheduler(object):
+    """
+    Runs the packages of the queue in worker processes (fork)
+
+    The packages of the same journal are converted one at a time
+    (lock_journal), because they share the serial folders and the aop bases.
+    The copies of title and issue databases and the scilista have their own
+    locks, and some stages (validation, transfer) have a maximum number of
+    packages running them at the same time.
+    """
+
+    def __init__(self, workers, queue_size, stage_limits):
+        self.workers = workers
+        self.queue_size = max(queue_size, workers)
+        self.db_copy_lock = multiprocessing.Lock()
+        self.scilista_lock = multiprocessing.Lock()
+        self.journal_locks = [multiprocessing.Lock() for i in range(JOURNAL_LOCKS)]
+        self.stages = {name: multiprocessing.BoundedSemaphore(limit) for name, limit in stage_limits.items()}
+        self.locked = []
+
+    def lock_journal(self, acron):
+        if isinstance(acron, unicode):
+            acron = acron.encode('utf-8')
+        lock = self.journal_locks[zlib.crc32(acron) % JOURNAL_LOCKS]
+        if not lock in self.locked:
+            lock.acquire()
+            self.locked.append(lock)
+
+    def release_locks(self):
+        while len(self.locked) > 0:
+            self.locked.pop().release()
+
+    def stage(self, name):
+        return self.stages[name]
+
+    def execute(self, function, args):
+        try:
+            return function(*args)
+        finally:
+            self.release_locks()
+
+    def run(self, function, items):
+        """
+        Returns the results of function(*item), in the order of items
+        At most queue_size items are sent to the workers at a time
+        """
+        if self.workers == 1 or len(items) == 1:
+            return [self.execute(function, item) for item in items]
+        results = []
+        running = []
+        pool = multiprocessing.Pool(self.workers)
+        try:
+            for item in items:
+                if len(running) >= self.queue_size:
+                    results.append(running.pop(0).get())
+                running.append(pool.apply_async(execute_scheduled, (function, item)))
+            results.extend([result.get() for result in running])
+        finally:
+            pool.close()
+            pool.join()
+        return results
+
+
+def execute_scheduled(function, args):
+    # runs in the worker processes, which inherit converter_env (fork)
+    return converter_env.scheduler.execute(function, args)
 
 
 def register_log(message):
@@ -189,12 +264,17 @@ class Conversion(object):
                 self.actions[name] = '-'
                 #self.complete_issue_items[name] = self.previous_registered_articles[name]
         self.changed_orders = {}
+        self.manifest = serial_files.ArticlesManifest(self.pkg.issue_files.manifest_filename)
+        # the files are read only if they are compared with the registered ones
+        self.files_hashes = None
+        if skip_identical_xml:
+            self.files_hashes = serial_files.articles_files_hashes(self.pkg.pkg_path, self.pkg.articles.keys())
         for name, article in self.pkg.articles.items():
             action = 'add'
             if name in self.previous_registered_articles.keys():
                 action = 'update'
                 if skip_identical_xml:
-                    if fs_utils.read_file(self.pkg.issue_files.base_source_path + '/' + name + '.xml') == fs_utils.read_file(self.pkg.pkg_path + '/' + name + '.xml'):
+                    if self.is_registered_version(name):
                         action = 'skip-update'
                 if action == 'update':
                     self.pkg.articles[name].creation_date = self.previous_registered_articles[name].creation_date
@@ -208,6 +288,17 @@ class Conversion(object):
             unmatched_orders_errors = ''.join([html_reports.p_message(validation_status.STATUS_WARNING + ': ' + _('orders') + ' ' + _('of') + ' ' + name + ': ' + ' -> '.join(list(order))) for name, order in self.changed_orders.items()])
         self.changed_orders_validations = pkg_reports.ValidationsResults(unmatched_orders_errors)
 
+    def is_registered_version(self, xml_name):
+        """
+        Returns True if the XML and the related files (pdf, images, ...) of
+        xml_name are the same as the registered ones
+        """
+        registered_hashes = self.manifest.get(xml_name)
+        if registered_hashes is None:
+            # registered before the manifest, only the XML can be compared
+            return fs_utils.read_file(self.pkg.issue_files.base_source_path + '/' + xml_name + '.xml') == fs_utils.read_file(self.pkg.pkg_path + '/' + xml_name + '.xml')
+        return registered_hashes == self.files_hashes.get(xml_name)
+
     @property
     def selected_articles(self):
         _selected_articles = None
@@ -323,6 +414,7 @@ class Conversion(object):
         n = '/' + str(len(self.pkg.articles))
 
         utils.display_message('Converting...')
+        pending = []
         for xml_name in self.pkg.xml_name_sorted_by_order:
             index += 1
             item_label = str(index) + n + ' - ' + xml_name
@@ -332,6 +424,9 @@ class Conversion(object):
             if not self.actions[xml_name] in ['add', 'update']:
                 xc_result = 'skipped'
             else:
+                if self.depends_on_pending(xml_name, pending):
+                    self.convert_pending(pending)
+                    pending = []
                 self.db.aop_manager.check_aop(self.pkg.articles[xml_name])
                 permission = is_conversion_allowed(self.pkg.articles[xml_name].issue_pub_dateiso, len(self.pkg.articles[xml_name].references), pkg_validator)
 
@@ -344,12 +439,12 @@ class Conversion(object):
                     if xml_name in self.changed_orders.keys():
                         incorrect_order, curr_order = self.changed_orders[xml_name]
 
-                    article_utils.normalize_affiliations(self.pkg.articles[xml_name])
-                    self.db.evaluate(self.pkg.issue_models.record, self.pkg.articles[xml_name], valid_aop, incorrect_order)
+                    pending.append((xml_name, valid_aop, incorrect_order))
                 else:
                     xc_result = 'rejected'
             if xc_result is not None:
                 self.conversion_status[xc_result].append(xml_name)
+        self.convert_pending(pending)
 
         is_package_registered = self.db.finish_conversion(self.pkg.pkg_path, self.pkg.issue_models.record)
         self.conversion_status['converted'] = self.db.is_converted
@@ -358,10 +453,60 @@ class Conversion(object):
         registered_scilista_item = None
         if is_package_registered is True:
             registered_scilista_item = self.pkg.acron_issue_label
+            registered_names = self.db.registered_articles.keys()
+            if self.files_hashes is None:
+                # no hashes: the previous ones of the converted articles are removed
+                converted_hashes = {}
+                registered_names = [xml_name for xml_name in registered_names if not xml_name in self.db.is_converted]
+            else:
+                converted_hashes = {xml_name: self.files_hashes[xml_name] for xml_name in self.db.is_converted}
+            self.manifest.save(converted_hashes, registered_names)
             if not converter_env.is_windows:
                 self.db.generate_windows_version()
         return registered_scilista_item
 
+    def depends_on_pending(self, xml_name, pending):
+        """
+        Returns True if the conversion of xml_name depends on the registration
+        of the pending articles (replaced orders or excluded ex aop)
+        """
+        article = self.pkg.articles[xml_name]
+        incorrect_order = self.changed_orders.get(xml_name, [None, None])[0]
+        for _xml_name, valid_aop, _incorrect_order in pending:
+            if article.order == _incorrect_order:
+                return True
+            if incorrect_order is not None and incorrect_order == self.pkg.articles[_xml_name].order:
+                return True
+        ex_aop_items = [valid_aop for _xml_name, valid_aop, _incorrect_order in pending if valid_aop is not None]
+        return self.db.aop_manager.is_affected_by_ex_aop(article, ex_aop_items)
+
+    def convert_pending(self, pending):
+        """
+        Creates the .id files of the pending articles, using converter_env.conversion_workers
+        processes, and registers the results in the order of the articles
+        """
+        xml_names = [xml_name for xml_name, valid_aop, incorrect_order in pending]
+        workers = min(converter_env.conversion_workers, len(xml_names))
+        if multiprocessing.current_process().daemon:
+            # package worker (PackageScheduler), which can not create processes
+            workers = 1
+        article_utils.normalize_package_affiliations([self.pkg.articles[xml_name] for xml_name in xml_names])
+        if workers > 1 and not converter_env.is_windows:
+            global pending_conversion
+            pending_conversion = self
+            self.db.create_id_paths()
+            pool = multiprocessing.Pool(workers)
+            try:
+                id_created = dict(pool.map(create_pending_id_file, xml_names))
+            finally:
+                pool.close()
+                pool.join()
+                pending_conversion = None
+        else:
+            id_created = dict([create_article_id_file(self, xml_name) for xml_name in xml_names])
+        for xml_name, valid_aop, incorrect_order in pending:
+            self.db.register_evaluation(self.pkg.articles[xml_name], id_created[xml_name], valid_aop, incorrect_order)
+
     @property
     def pkg_xc_validations(self):
         validations = pkg_reports.PackageValidationsResults(self.pkg.issue_files.base_reports_path, 'xc-', '')
@@ -371,6 +516,15 @@ class Conversion(object):
         return validations
 
 
+def create_article_id_file(conversion, xml_name):
+    return (xml_name, conversion.db.create_id_file(conversion.pkg.issue_models.record, conversion.pkg.articles[xml_name]))
+
+
+def create_pending_id_file(xml_name):
+    # runs in the worker processes, which inherit pending_conversion (fork)
+    return create_article_id_file(pending_conversion, xml_name)
+
+
 def conclusion_message(total, converted, not_converted, xc_status, acron_issue_label):
     app_site = converter_env.web_app_site if converter_env.web_app_site is not None else _('scielo web site')
     status = ''
@@ -449,7 +603,9 @@ def convert_package(src_path):
     pkg = pkg_reports.PkgArticles(pkg_articles, pkg_path)
 
     fs_utils.append_file(log_package, 'identify_issue')
-    issue_error_msg = pkg.identify_issue(converter_env.db_manager, pkg_name)
+    with converter_env.scheduler.db_copy_lock:
+        issue_error_msg = pkg.identify_issue(converter_env.db_manager, pkg_name)
+    converter_env.scheduler.lock_journal(pkg.acron_issue_label.split(' ')[0])
 
     fs_utils.append_file(log_package, 'pkg.xml_list()')
     report_components['xml-files'] = pkg.xml_list()
@@ -491,7 +647,8 @@ def convert_package(src_path):
 
             fs_utils.append_file(log_package, 'pkg_validator.validate_articles_pkg_xml_and_data')
 
-            pkg_validator.validate_articles_pkg_xml_and_data(doc_file_info_items, dtd_files, False, conversion.selected_articles.keys())
+            with converter_env.scheduler.stage('validation'):
+                pkg_validator.validate_articles_pkg_xml_and_data(doc_file_info_items, dtd_files, False, conversion.selected_articles.keys())
 
             pkg_xml_fatal_errors = pkg_validator.pkg_xml_structure_validations.fatal_errors + pkg_validator.pkg_xml_content_validations.fatal_errors
 
@@ -839,67 +996,98 @@ def execute_converter(package_paths, collection_name=None):
         if not isinstance(package_paths, list):
             package_paths = [package_paths]
 
-        for package_path in package_paths:
-            package_folder = os.path.basename(package_path)
-            utils.display_message(package_path)
-            scilista_items = []
-            xc_status = 'interrupted'
-            stats_msg = ''
-            report_location = None
-            try:
-                scilista_items, xc_status, stats_msg, report_location = convert_package(package_path)
-            except Exception as e:
-                if config.queue_path is not None:
-                    fs_utils.delete_file_or_folder(package_path)
-                if config.email_subject_invalid_packages is not None:
-                    send_message(mailer, config.email_to_adm, '[Step 1]' + config.email_subject_invalid_packages, config.email_text_invalid_packages + '\n' + package_folder + '\n' + str(e))
-                if len(package_paths) == 1:
-                    raise
-
-            try:
-                acron, issue_id = scilista_items[0].split(' ')
-
-                if xc_status in ['accepted', 'approved']:
-                    if config.collection_scilista is not None:
-                        open(config.collection_scilista, 'a+').write('\n'.join(scilista_items) + '\n')
-
-                    if config.is_enabled_transference:
-                        transfer_website_files(acron, issue_id, config.local_web_app_path, config.transference_user, config.transference_servers, config.remote_web_app_path)
-
-                if report_location is not None:
-                    if config.is_windows:
-                        pkg_reports.display_report(report_location)
-
-                    if config.email_subject_package_evaluation is not None:
-                        results = ' '.join(XC_STATUS.get(xc_status, [])) + ' ' + stats_msg
-                        link = converter_env.web_app_site + '/reports/' + acron + '/' + issue_id + '/' + os.path.basename(report_location)
-                        report_location = '<html><body>' + html_reports.link(link, link) + '</body></html>'
-
-                        transfer_report_files(acron, issue_id, config.local_web_app_path, config.transference_user, config.transference_servers, config.remote_web_app_path)
-                        send_message(mailer, config.email_to, config.email_subject_package_evaluation + u' ' + package_folder + u': ' + results, report_location)
-
-            except Exception as e:
-                if config.email_subject_invalid_packages is not None:
-                    send_message(mailer, config.email_to_adm, '[Step 2]' + config.email_subject_invalid_packages, config.email_text_invalid_packages + '\n' + package_folder + '\n' + str(e))
-
-                if len(package_paths) == 1:
-                    print('exception as finishing')
-                    raise
+        is_single_package = len(package_paths) == 1
+        items = [(package_path, config, mailer, is_single_package) for package_path in package_paths]
+        if converter_env.scheduler.workers > 1:
+            for timing in converter_env.scheduler.run(process_package_in_worker, items):
+                converter_env.db_manager.db_isis.cisis.runner.merge(timing)
+        else:
+            converter_env.scheduler.run(process_package, items)
 
         if len(invalid_pkg_files) > 0:
             if config.email_subject_invalid_packages is not None:
                 send_message(mailer, config.email_to, config.email_subject_invalid_packages, config.email_text_invalid_packages + '\n'.join(invalid_pkg_files))
 
+        utils.display_message(converter_env.db_manager.db_isis.cisis.runner.report())
+
     utils.display_message(_('finished'))
 
 
+def process_package(package_path, config, mailer, is_single_package):
+    """
+    Converts the package, registers it in scilista, transfers the files and
+    sends the report
+    Returns the elapsed time of the cisis commands
+    """
+    package_folder = os.path.basename(package_path)
+    utils.display_message(package_path)
+    scilista_items = []
+    xc_status = 'interrupted'
+    stats_msg = ''
+    report_location = None
+    try:
+        scilista_items, xc_status, stats_msg, report_location = convert_package(package_path)
+    except Exception as e:
+        if config.queue_path is not None:
+            fs_utils.delete_file_or_folder(package_path)
+        if config.email_subject_invalid_packages is not None:
+            send_message(mailer, config.email_to_adm, '[Step 1]' + config.email_subject_invalid_packages, config.email_text_invalid_packages + '\n' + package_folder + '\n' + str(e))
+        if is_single_package:
+            raise
+
+    try:
+        acron, issue_id = scilista_items[0].split(' ')
+
+        if xc_status in ['accepted', 'approved']:
+            if config.collection_scilista is not None:
+                with converter_env.scheduler.scilista_lock:
+                    open(config.collection_scilista, 'a+').write('\n'.join(scilista_items) + '\n')
+
+            if config.is_enabled_transference:
+                with converter_env.scheduler.stage('transfer'):
+                    transfer_website_files(acron, issue_id, config.local_web_app_path, config.transference_user, config.transference_servers, config.remote_web_app_path)
+
+        if report_location is not None:
+            if config.is_windows:
+                pkg_reports.display_report(report_location)
+
+            if config.email_subject_package_evaluation is not None:
+                results = ' '.join(XC_STATUS.get(xc_status, [])) + ' ' + stats_msg
+                link = converter_env.web_app_site + '/reports/' + acron + '/' + issue_id + '/' + os.path.basename(report_location)
+                report_location = '<html><body>' + html_reports.link(link, link) + '</body></html>'
+
+                with converter_env.scheduler.stage('transfer'):
+                    transfer_report_files(acron, issue_id, config.local_web_app_path, config.transference_user, config.transference_servers, config.remote_web_app_path)
+                send_message(mailer, config.email_to, config.email_subject_package_evaluation + u' ' + package_folder + u': ' + results, report_location)
+
+    except Exception as e:
+        if config.email_subject_invalid_packages is not None:
+            send_message(mailer, config.email_to_adm, '[Step 2]' + config.email_subject_invalid_packages, config.email_text_invalid_packages + '\n' + package_folder + '\n' + str(e))
+
+        if is_single_package:
+            print('exception as finishing')
+            raise
+
+
+def process_package_in_worker(package_path, config, mailer, is_single_package):
+    """
+    Runs process_package in a worker process of PackageScheduler
+    Returns the elapsed time of the cisis commands of the package
+    """
+    runner = converter_env.db_manager.db_isis.cisis.runner
+    runner.timing = {}
+    process_package(package_path, config, mailer, is_single_package)
+    return runner.timing
+
+
 def prepare_env(config):
     global converter_env
 
     if converter_env is None:
         converter_env = ConverterEnv()
 
-    db_isis = dbm_isis.IsisDAO(dbm_isis.UCISIS(dbm_isis.CISIS(config.cisis1030), dbm_isis.CISIS(config.cisis1660)))
+    cisis_runner = dbm_isis.CommandRunner()
+    db_isis = dbm_isis.IsisDAO(dbm_isis.UCISIS(dbm_isis.CISIS(config.cisis1030, cisis_runner), dbm_isis.CISIS(config.cisis1660, cisis_runner)))
     converter_env.db_manager = xc_models.DBManager(db_isis, [config.title_db, config.title_db_copy, CURRENT_PATH + '/title.fst'], [config.issue_db, config.issue_db_copy, CURRENT_PATH + '/issue.fst'], config.serial_path, config.local_web_app_path)
 
     converter_env.local_web_app_path = config.local_web_app_path
@@ -910,3 +1098,5 @@ def prepare_env(config):
     converter_env.max_fatal_error = config.max_fatal_error
     converter_env.max_error = config.max_error
     converter_env.max_warning = config.max_warning
+    converter_env.conversion_workers = config.conversion_workers
+    converter_env.scheduler = PackageScheduler(1 if config.is_windows else config.package_workers, config.package_queue_size, {'validation': config.max_validations, 'transfer': config.max_transfers})
@@ -1,6 +1,7 @@
 # coding=utf-8
 import os
 from datetime import datetime
+from multiprocessing.pool import ThreadPool
 
 from __init__ import _
 import fs_utils
@@ -73,33 +74,50 @@ def java_xml_utils_dtd_validation(xml_filename, report_filename, doctype):
 
 
 def java_xml_utils_style_validation(xml_filename, doctype, report_filename, xsl_prep_report, xsl_report):
+    return java_xml_utils_style_validation_items([(xml_filename, report_filename)], doctype, xsl_prep_report, xsl_report)[0]
+
+
+def java_xml_utils_style_validation_items(items, doctype, xsl_prep_report, xsl_report):
+    """
+    items: [(xml_filename, report_filename), ...]
+    Each stylesheet is run once for all the items
+    Returns the list of is_valid_style
+    """
     # STYLE CHECKER REPORT
     register_log('java_xml_utils_style_validation: inicio')
-    is_valid_style = False
-    xml_report = report_filename.replace('.html', '.xml')
-    if os.path.exists(xml_report):
-        os.unlink(xml_report)
-    if os.path.exists(report_filename):
-        os.unlink(report_filename)
+    prepared = []
+    for xml_filename, report_filename in items:
+        xml_report = report_filename.replace('.html', '.xml')
+        if os.path.exists(xml_report):
+            os.unlink(xml_report)
+        if os.path.exists(report_filename):
+            os.unlink(report_filename)
+        bkp_xml_filename = xml_utils.apply_dtd(xml_filename, doctype)
+        prepared.append((xml_filename, report_filename, xml_report, bkp_xml_filename))
 
     parameters = {}
-    bkp_xml_filename = xml_utils.apply_dtd(xml_filename, doctype)
-    if java_xml_utils.xml_transform(xml_filename, xsl_prep_report, xml_report, parameters):
-        #parameters = {'filename': xml_report}
-        java_xml_utils.xml_transform(xml_report, xsl_report, report_filename, parameters)
-    else:
-        fs_utils.write_file(report_filename, validation_status.STATUS_FATAL_ERROR + ': ' + _('Unable to create') + ' ' + report_filename)
-    if os.path.isfile(report_filename):
-        c = fs_utils.read_file(report_filename)
-        is_valid_style = ('Total of errors = 0' in c) and (('Total of warnings = 0' in c) or (not 'Total of warnings =' in c))
-
-    if os.path.isfile(bkp_xml_filename):
-        xml_utils.restore_xml_file(xml_filename, bkp_xml_filename)
-
-    if os.path.isfile(xml_report):
-        os.unlink(xml_report)
+    prepared_reports = java_xml_utils.xml_transform_items([(item[0], item[2]) for item in prepared], xsl_prep_report, parameters)
+    #parameters = {'filename': xml_report}
+    java_xml_utils.xml_transform_items([(item[2], item[1]) for item, done in zip(prepared, prepared_reports) if done], xsl_report, parameters)
+
+    results = []
+    for item, done in zip(prepared, prepared_reports):
+        xml_filename, report_filename, xml_report, bkp_xml_filename = item
+        is_valid_style = False
+        if not done:
+            fs_utils.write_file(report_filename, validation_status.STATUS_FATAL_ERROR + ': ' + _('Unable to create') + ' ' + report_filename)
+        if os.path.isfile(report_filename):
+            c = fs_utils.read_file(report_filename)
+            is_valid_style = ('Total of errors = 0' in c) and (('Total of warnings = 0' in c) or (not 'Total of warnings =' in c))
+
+        if os.path.isfile(bkp_xml_filename):
+            xml_utils.restore_xml_file(xml_filename, bkp_xml_filename)
+
+        if os.path.isfile(xml_report):
+            os.unlink(xml_report)
+        results.append(is_valid_style)
     register_log('java_xml_utils_style_validation: fim')
-    return is_valid_style
+    return results
 
 
 def style_checker_statistics(report_filename):
@@ -133,13 +151,14 @@ def style_checker_statistics(report_filename):
     return (total_f, total_e, total_w)
 
 
+def use_packtools(database_name):
+    return database_name == 'scielo' and IS_PACKTOOLS_INSTALLED
+
+
 def dtd_validation(xml_filename, report_filename, doctype, database_name):
     if os.path.isfile(report_filename):
         os.unlink(report_filename)
-    _use_packtools = (database_name == 'scielo')
-    if _use_packtools:
-        _use_packtools = IS_PACKTOOLS_INSTALLED
-    if _use_packtools:
+    if use_packtools(database_name):
         return packtools_dtd_validation(xml_filename, report_filename)
     else:
         return java_xml_utils_dtd_validation(xml_filename, report_filename, doctype)
@@ -148,15 +167,65 @@ def dtd_validation(xml_filename, report_filename, doctype, database_name):
 def style_validation(xml_filename, doctype, report_filename, xsl_prep_report, xsl_report, database_name):
     if os.path.isfile(report_filename):
         os.unlink(report_filename)
-    _use_packtools = (database_name == 'scielo')
-    if _use_packtools:
-        _use_packtools = IS_PACKTOOLS_INSTALLED
-    if _use_packtools:
+    if use_packtools(database_name):
         return packtools_style_validation(xml_filename, report_filename)
     else:
         return java_xml_utils_style_validation(xml_filename, doctype, report_filename, xsl_prep_report, xsl_report)
 
 
+def validate_articles_xml(items, dtd_files, workers=1):
+    """
+    items: [(xml_filename, dtd_report_filename, style_report_filename), ...]
+    Validates the files in workers threads. The style checker runs java once
+    for each group of files
+    Returns the list of (xml, is_valid_dtd, (f, e, w)), in the order of items
+    """
+    def load_and_validate_dtd(item):
+        xml_filename, dtd_report_filename, style_report_filename = item
+        xml, e = xml_utils.load_xml(xml_filename)
+        is_valid_dtd = dtd_validation(xml_filename, dtd_report_filename, dtd_files.doctype_with_local_path, dtd_files.database_name)
+        return (xml, e, is_valid_dtd)
+
+    def validate_style(group):
+        if use_packtools(dtd_files.database_name):
+            for xml_filename, style_report_filename in group:
+                style_validation(xml_filename, dtd_files.doctype_with_local_path, style_report_filename, dtd_files.xsl_prep_report, dtd_files.xsl_report, dtd_files.database_name)
+        else:
+            for xml_filename, style_report_filename in group:
+                if os.path.isfile(style_report_filename):
+                    os.unlink(style_report_filename)
+            java_xml_utils_style_validation_items(group, dtd_files.doctype_with_local_path, dtd_files.xsl_prep_report, dtd_files.xsl_report)
+
+    register_log('validate_articles_xml: inicio')
+    workers = max(min(workers, len(items)), 1)
+    pool = ThreadPool(workers) if workers > 1 else None
+    try:
+        _map = pool.map if pool is not None else map
+        loaded = _map(load_and_validate_dtd, items)
+
+        style_items = []
+        for item, result in zip(items, loaded):
+            xml_filename, dtd_report_filename, style_report_filename = item
+            xml, e, is_valid_dtd = result
+            if e is None:
+                style_items.append((xml_filename, style_report_filename))
+            else:
+                text = validation_status.STATUS_FATAL_ERROR + ': ' + _('Unable to load') + ' ' + xml_filename + '\n' + str(e).decode('utf-8')
+                fs_utils.write_file(style_report_filename, text)
+        _map(validate_style, [style_items[i::workers] for i in range(0, workers) if len(style_items[i::workers]) > 0])
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    results = []
+    for item, result in zip(items, loaded):
+        xml, e, is_valid_dtd = result
+        results.append((xml, is_valid_dtd, style_checker_statistics(item[2])))
+    register_log('validate_articles_xml: fim')
+    return results
+
+
 def validate_article_xml(xml_filename, dtd_files, dtd_report_filename, style_report_filename):
     register_log('validate_article_xml: inicio')
     is_valid_style = False
@@ -19,6 +19,7 @@ class JSON2IDFile:
         """
         self.converter_utf8_iso = converter_utf8_iso
         self.convert2iso = convert2iso
+        self.record_content = None
         
 
     def set_file_data(self, filename, report):
@@ -67,6 +68,16 @@ class JSON2IDFile:
     
     
     def save_document_data(self, fields_info):
+        # the fields of the record are written at once
+        self.record_content = []
+        try:
+            self.__format_document_data__(fields_info)
+        finally:
+            content = ''.join(self.record_content)
+            self.record_content = None
+            self.__write__(content)
+
+    def __format_document_data__(self, fields_info):
         if isinstance(fields_info, dict):
             ##print(fields_info.keys())
             tag_list = [ int(tag) for tag in fields_info.keys() if tag.isdigit()]
@@ -219,6 +230,12 @@ class JSON2IDFile:
         return iso
 
     def __write__(self, content):
+        if self.record_content is not None:
+            try:
+                self.record_content.append(str(content))
+            except:
+                self.report.write('Unable to write content in id filename. ', True, True, True, content)
+            return
         f = open(self.filename, 'a+')
         try:
             f.write(content)
@@ -231,11 +248,8 @@ def u_encode(u, encoding):
     r = u
     if isinstance(u, unicode):
         try:
-            r = u.encode(encoding)
+            r = u.encode(encoding, 'xmlcharrefreplace')
         except Exception as e:
-            try:
-                r = u.encode(encoding, 'xmlcharrefreplace')
-            except Exception as e:
-                r = u.encode(encoding, 'replace')
+            r = u.encode(encoding, 'replace')
     return r
 
@@ -6,45 +6,12 @@ class ConverterUTF8_ISO:
         pass 
 
     def utf8_2_iso(self, utf8):
-        u = utf8.decode('utf-8')
-        try:
-            iso = u.encode('iso-8859-1')
-        except:
-            iso = self.utf8_2_iso_by_words(utf8)
-        return iso
-
-    def utf8_2_iso_by_words(self, utf8):
-        words = utf8.split(' ')
-        new = []
-        for w in words:
-            new.append(self.utf8_2_iso_by_word(w))
-        return ' '.join(new)
-
-
-    def utf8_2_iso_by_word(self, utf8):
-        u = utf8.decode('utf-8')
-        try:
-            iso = u.encode('iso-8859-1')
-        except:
-            iso = self.utf8_2_iso_by_characters(utf8)
-        return iso
-
-
-
-    def utf8_2_iso_by_characters(self, utf8):
-        new = []
-        for c in utf8:
-            new.append(self.utf8_2_iso_by_character(c))
-        return ''.join(new)
-
-    def utf8_2_iso_by_character(self, utf8):
-        
-        try:
+        """
+        Converts utf8 to iso-8859-1 in one pass
+        The characters which are not in iso-8859-1 are converted to numeric entities (&#N;)
+        """
+        if isinstance(utf8, unicode):
+            u = utf8
+        else:
             u = utf8.decode('utf-8')
-            iso = u.encode('iso-8859-1')
-        except:
-            iso = utf8
-        return iso
-
-    
-        
+        return u.encode('iso-8859-1', 'xmlcharrefreplace')
@@ -1,4 +1,28 @@
 from unicodedata import normalize
+import re
+
+
+# &name; &#number; and their escaped forms &amp;name; &amp;#number;
+ENTITY = re.compile(r'&(amp;)?([^&;]*;)')
+
+
+class EntitiesReplacer:
+    """
+    Replaces the entities of table, escaped or not, in one scan of the content
+    table: {'&name;': replacement, ...}
+    """
+
+    def __init__(self, table):
+        self.table = table
+
+    def replace(self, content):
+        if not '&' in content:
+            return content
+        return ENTITY.sub(self.replace_entity, content)
+
+    def replace_entity(self, match):
+        return self.table.get('&' + match.group(2), match.group(0))
+
 
 class TableEntities:
     def __init__(self, filename = 'entities'):
@@ -37,6 +61,11 @@ class TableEntities:
                             self.table_number2char[number_ent] = char
                         self.table_noaccent[number_ent] = no_accent
 
+        # compiled once and shared by all the converted documents
+        self.number2char_replacer = EntitiesReplacer(self.table_number2char)
+        self.named2number_replacer = EntitiesReplacer(self.table_named2number)
+        self.named2char_replacer = EntitiesReplacer(self.table_named2char)
+
     def is_valid_char(self, char):
         r = False
         if char != '':
@@ -52,30 +81,13 @@ class TableEntities:
         return  r
 
     def number2char(self, content):
-        for k,v in self.table_number2char.items():
-            k2 = k.replace('&', '&amp;')
-            content = content.replace(k2, v)
-            content = content.replace(k, v)
-            
-
-        return content
+        return self.number2char_replacer.replace(content)
 
     def name2number(self, content):
-        for k,v in self.table_named2number.items():
-            k2 = k.replace('&', '&amp;')
-            content = content.replace(k2, v)
-            content = content.replace(k, v)
-            
-            
-        return content
+        return self.named2number_replacer.replace(content)
 
     def name2char(self, content):
-        for k,v in self.table_named2char.items():            
-            k2 = k.replace('&', '&amp;')
-            content = content.replace(k2, v)
-            content = content.replace(k, v)
-            
-        return content
+        return self.named2char_replacer.replace(content)
 
     #def find_number_entities(self, content):
     #    l = []
@@ -1,6 +1,87 @@
 
 from datetime import datetime
 import os
+import atexit
+import threading
+import Queue
+
+
+WRITER_QUEUE_SIZE = 10000
+WRITER_BATCH_SIZE = 500
+
+
+class BufferedWriter:
+    """
+    Appends the messages to the files in a background thread
+    The queue is bounded, so write() waits when the thread is behind
+    """
+
+    def __init__(self, queue_size = WRITER_QUEUE_SIZE):
+        self.queue = Queue.Queue(queue_size)
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def write(self, filename, content):
+        self.queue.put((filename, content))
+
+    def flush(self):
+        self.queue.join()
+
+    def run(self):
+        while True:
+            items = [self.queue.get()]
+            while len(items) < WRITER_BATCH_SIZE:
+                try:
+                    items.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+            # consecutive messages of the same file are written at once
+            groups = []
+            for filename, content in items:
+                if len(groups) > 0 and groups[-1][0] == filename:
+                    groups[-1][1].append(content)
+                else:
+                    groups.append((filename, [content]))
+            for filename, contents in groups:
+                try:
+                    append_content(filename, contents)
+                except Exception as e:
+                    print('ERROR: unable to write ' + filename)
+                    print(e)
+            for item in items:
+                self.queue.task_done()
+
+
+# None: the messages are written immediately
+writer = None
+
+
+def use_buffered_writer(queue_size = WRITER_QUEUE_SIZE):
+    global writer
+    if writer is None:
+        writer = BufferedWriter(queue_size)
+        atexit.register(flush)
+
+
+def append_content(filename, contents):
+    f = open(filename, 'a+')
+    for content in contents:
+        f.write(content)
+    f.close()
+
+
+def write_content(filename, content):
+    if writer is None:
+        append_content(filename, [content])
+    else:
+        writer.write(filename, content)
+
+
+def flush():
+    if writer is not None:
+        writer.flush()
+
 
 class Report:
 
@@ -52,11 +133,10 @@ class Report:
     
 
     def __write__(self, filename, content):
-        f = open(filename, 'a+')
-        f.write(content + "\n")
-        f.close() 
+        write_content(filename, content + "\n")
 
     def read(self, filename):
+        flush()
         f = open(filename, 'r')
         c = f.read()
         f.close()
@@ -76,6 +156,7 @@ class Report:
         return r
 
     def delete_filename(self, filename):
+        flush()
         if os.path.isfile(filename):
             try:
                 os.remove(filename)
@@ -84,9 +165,10 @@ class Report:
         return (not os.path.isfile(filename))
     
     def __write__(self, filename, content):
-        f = open(filename, 'a+')
-        f.write(content + "\n")
-        f.close()   
+        write_content(filename, content + "\n")
+
+    def flush(self):
+        flush()
     
     def what_time(self):
         return datetime.now().isoformat() 
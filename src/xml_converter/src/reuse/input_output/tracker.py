@@ -1,6 +1,8 @@
 import os
 from datetime import date, datetime
 
+from report import write_content, flush
+
 
 class Tracker:
     def __init__(self, path, filename):
@@ -18,6 +20,7 @@ class Tracker:
         suffix = ''
         if frequency == 'daily':
             suffix = '-' + self.daily
-        f = open(self.filename + suffix + '.log', 'a+')
-        f.write(datetime.now().isoformat() + '|' + name + '|' + status + '\n')
-        f.close()
+        write_content(self.filename + suffix + '.log', datetime.now().isoformat() + '|' + name + '|' + status + '\n')
+
+    def flush(self):
+        flush()
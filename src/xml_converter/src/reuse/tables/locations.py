@@ -1,5 +1,8 @@
 # -*- coding: utf-8 -*-
 
+from table_cache import TableCache
+
+
 class Locations:
 
     def __init__(self, filename):
@@ -14,6 +17,9 @@ class Locations:
         self.location_parts['city'] = {}
         self.location_parts['state'] = {}
 
+        # LOCATION: (part, count), the part where LOCATION is more frequent
+        self.classification = {}
+
     def read_file(self, filename):
     	f = open(filename, 'r')
         content = f.readlines()
@@ -21,6 +27,16 @@ class Locations:
         return content
     
     def load_locations(self):
+        cache = TableCache(self.filename)
+        data = cache.load()
+        if data is None:
+            self.read_locations()
+            self.classify_locations()
+            cache.save((self.location_parts, self.city_state, self.classification))
+        else:
+            self.location_parts, self.city_state, self.classification = data
+
+    def read_locations(self):
         rows = self.read_file(self.filename)
         for row in rows:
             location = row.replace('\n', '')
@@ -33,7 +49,7 @@ class Locations:
 
                 i = 0
                 for part_name in self.part_order:
-                    if not loc_upper[i] in self.location_parts[part_name].keys():
+                    if not loc_upper[i] in self.location_parts[part_name]:
                         self.location_parts[part_name][loc_upper[i]] = 0
                     self.location_parts[part_name][loc_upper[i]] += 1
                 
@@ -41,6 +57,27 @@ class Locations:
 
                 
     
+    def classify_locations(self):
+        self.classification = {}
+        for part_name in self.part_order:
+            for be in self.location_parts[part_name]:
+                if not be in self.classification:
+                    self.classification[be] = self.classify(be)
+
+    def classify(self, be):
+        count = {'country':0, 'state': 0, 'city': 0}
+        for part_name in self.part_order:
+            if be in self.location_parts[part_name]:
+                count[part_name] = self.location_parts[part_name][be]
+
+        greater = 0
+        key = ''
+        for k, c in count.items():
+            if c > greater:
+                greater = c
+                key = k
+        return (key, greater)
+
     def return_the_city(self, list):
         r = ''
         for item in list:
@@ -66,19 +103,7 @@ class Locations:
         return r
 
     def is_what(self, might_be):
-        be = might_be.upper()
-        count = {'country':0, 'state': 0, 'city': 0}
-        for part_name in self.part_order:
-            if be in self.location_parts[part_name].keys():
-                count[part_name] = self.location_parts[part_name][be]
-
-        greater = 0
-        key = ''
-        for k, c in count.items():
-            if c > greater:
-                greater = c
-                key = k
-        return key 
+        return self.classification.get(might_be.upper(), ('', 0))[0]
 
 
     def is_country(self, might_be):
@@ -106,7 +131,7 @@ class Locations:
                 
             k = city + state
         
-            if k in self.city_state.keys():
+            if k in self.city_state:
                 r = self.city_state[k]
         return r
 
@@ -2,6 +2,8 @@
 
 import os.path 
 
+from table_cache import TableCache
+
 class NormalizedAffiliations:
 
     #def __init__(self, filename = 'inputs/valid_affiliations.seq', location_table = Locations('inputs/valid_locations.seq')):
@@ -22,6 +24,14 @@ class NormalizedAffiliations:
         return content
     
     def load_affiliations(self):
+        cache = TableCache(self.filename)
+        self.institution_names = cache.load()
+        if self.institution_names is None:
+            self.institution_names = {}
+            self.read_affiliations()
+            cache.save(self.institution_names)
+
+    def read_affiliations(self):
         rows = self.read_file(self.filename)
         for row in rows:
             affiliation = row.replace('\n', '')
@@ -32,7 +42,7 @@ class NormalizedAffiliations:
                 self.institution_names[loc[0].upper()] = loc[0]
 
     def is_institution_name(self, might_be):
-        return might_be.upper() in self.institution_names.keys()
+        return might_be.upper() in self.institution_names
 
     
     def generate_valid_table(self, input_filename, err_filename):
@@ -0,0 +1,43 @@
+import os
+import marshal
+
+
+class TableCache:
+    """
+    Binary copy (marshal) of the data loaded from a table file
+    It is valid while the table file keeps the same size and modification time
+    """
+
+    def __init__(self, table_filename):
+        self.table_filename = table_filename
+        self.filename = table_filename + '.cache'
+
+    @property
+    def signature(self):
+        stat = os.stat(self.table_filename)
+        return (stat.st_size, int(stat.st_mtime))
+
+    def load(self):
+        data = None
+        if os.path.isfile(self.filename):
+            try:
+                f = open(self.filename, 'rb')
+                signature, data = marshal.load(f)
+                f.close()
+                if signature != self.signature:
+                    data = None
+            except:
+                data = None
+        return data
+
+    def save(self, data):
+        try:
+            f = open(self.filename + '.tmp', 'wb')
+            marshal.dump((self.signature, data), f)
+            f.close()
+            if os.name == 'nt' and os.path.isfile(self.filename):
+                os.unlink(self.filename)
+            os.rename(self.filename + '.tmp', self.filename)
+        except Exception as e:
+            print('Unable to save ' + self.filename)
+            print(e)
@@ -1,119 +1,238 @@
 
 import json
 
+from xml.etree import ElementPath
+
+
+def compile_xpath(xpath):
+    # the same compilation of ElementPath.iterfind, done once by rule
+    # because the rules are more than the cache of ElementPath (100 paths)
+    if xpath[-1:] == '/':
+        xpath = xpath + '*'
+    if xpath[:1] == '/':
+        raise SyntaxError('cannot use absolute path on element')
+    tokens = list(ElementPath.xpath_tokenizer(xpath))
+    next = iter(tokens).next
+    token = next()
+    selector = []
+    while 1:
+        try:
+            selector.append(ElementPath.ops[token[0]](next, token))
+        except StopIteration:
+            raise SyntaxError('invalid path')
+        try:
+            token = next()
+            if token[0] == '/':
+                token = next()
+        except StopIteration:
+            break
+
+    # .//tag: the first two steps are resolved by the index of the tree
+    descendant_tag = None
+    if len(tokens) >= 3 and tokens[0] == ('.', '') and tokens[1] == ('//', '') and tokens[2][0] == '' and tokens[2][1] != '':
+        descendant_tag = tokens[2][1]
+    return (selector, descendant_tag)
+
+
+class XML2JSONRule:
+    """
+    Rule of XML2JSONTable compiled: selector, extractor and target key
+    """
+
+    def __init__(self, node_rules):
+        self.xpath = node_rules.xpath
+        self.to = node_rules.to
+        if node_rules.to == '' or node_rules.to == '_':
+            self.key = '_'
+        else:
+            self.key = node_rules.to
+        self.default = node_rules.default
+
+        if node_rules.attr != '':
+            self.extractor = 'attr'
+            self.attr_name = node_rules.attr[1:]
+        elif node_rules.xml:
+            self.extractor = 'xml'
+        else:
+            self.extractor = 'value'
+
+        self.children = [XML2JSONRule(child) for child in node_rules.children]
+
+        self.selector = None
+        self.descendant_tag = None
+        self.is_valid_xpath = True
+        if self.xpath != '':
+            try:
+                self.selector, self.descendant_tag = compile_xpath(self.xpath)
+            except:
+                self.is_valid_xpath = False
+
+    @property
+    def descendant_tags(self):
+        tags = [self.descendant_tag] if self.descendant_tag is not None else []
+        for child in self.children:
+            tags += child.descendant_tags
+        return tags
+
+
+class XML2JSONPlan:
+    """
+    XML2JSONTable compiled once and evaluated for each XML
+    """
+
+    def __init__(self, xml2json_table):
+        self.start = XML2JSONRule(xml2json_table.start)
+        self.indexed_tags = set(self.start.descendant_tags)
+
+
 class XML2JSON:
 
-    def __init__(self, xml2json_table, xml_tree, debug = True):
+    def __init__(self, xml2json_table, xml_tree, debug = False, debug_sampling = 100):
         #self.xml2json_table = XML2JSONTable(xml2json_table_filename)
         #self.debug = debug
         #self.xml_tree = XMLManager(TableEntAndChar())
         self.xml2json_table = xml2json_table
-        
-        self.debug = debug
-        
+        self.plan = XML2JSONPlan(xml2json_table)
+
+        # debug: trace the conversion of one of each debug_sampling XML
+        self.debug_enabled = debug
+        self.debug_sampling = max(1, debug_sampling)
+        self.debug = False
+        self.converted_total = 0
+
         self.xml_tree = xml_tree
-        
+
 
     def convert(self, xml_filename, report):
         self.dict = {}
-        self.report = report 
+        self.report = report
+        self.debug = self.debug_enabled and (self.converted_total % self.debug_sampling == 0)
+        self.converted_total += 1
 
         self.xml_tree.load(xml_filename, report)
         #if self.xml_filename.error_message
 
-        converted = self.__convert__(self.xml2json_table.start, None, None)
+        self.root_node = None
+        self.tags_index = None
 
-        report.write('converted', False, False, False, converted)  
-        return converted 
+        converted = self.__convert__(self.plan.start, None, None)
+
+        if self.debug:
+            report.write('converted', False, False, False, converted)
+        return converted
 
     def pretty(self, json_data):
         return json.dumps(json_data, sort_keys=True, indent=4)
-        
+
     def pretty_print(self, json_data):
         print(self.pretty(json_data))
-        
 
 
-    def __convert__(self, node_rules, xml_parent_node, parent_xml_parent_node, num = 1):
-        # node_rules.xpath = ./email
+    def index_tags(self, root_node):
+        # elements of the tags of .//tag rules, in document order, in one traversal
+        self.root_node = root_node
+        self.tags_index = {}
+        for tag in self.plan.indexed_tags:
+            self.tags_index[tag] = []
+        for elem in root_node.iter():
+            if elem.tag in self.tags_index:
+                self.tags_index[elem.tag].append(elem)
+
+    def return_nodes(self, rule, xml_parent_node):
+        if xml_parent_node is None:
+            nodes = self.xml_tree.return_nodes(rule.xpath, xml_parent_node)
+            if len(nodes) > 0:
+                self.index_tags(nodes[0])
+            return nodes
+        if rule.xpath == '':
+            return [xml_parent_node]
+        r = []
+        if rule.is_valid_xpath:
+            try:
+                context = ElementPath._SelectorContext(xml_parent_node)
+                if rule.descendant_tag is not None and xml_parent_node is self.root_node:
+                    result = [elem for elem in self.tags_index[rule.descendant_tag] if elem is not xml_parent_node]
+                    selector = rule.selector[2:]
+                else:
+                    result = [xml_parent_node]
+                    selector = rule.selector
+                for select in selector:
+                    result = select(context, result)
+                r = list(result)
+            except:
+                r = []
+                self.report.write('Invalid xpath: ' + rule.xpath, False, True, True)
+        else:
+            self.report.write('Invalid xpath: ' + rule.xpath, False, True, True)
+        return r
+
+    def __convert__(self, rule, xml_parent_node, parent_xml_parent_node, num = 1):
+        # rule.xpath = ./email
         if self.debug:
             self.report.write('__convert__ ')
-            self.report.write('node_rules.xpath', False, False, False, node_rules.xpath)
-        
-        xml_nodes = self.xml_tree.return_nodes(node_rules.xpath, xml_parent_node)
+            self.report.write('rule.xpath', False, False, False, rule.xpath)
+
+        xml_nodes = self.return_nodes(rule, xml_parent_node)
         # nodes = nodes de aff
-        if self.debug: 
+        if self.debug:
             self.report.write('xml_nodes', False, False, False, xml_nodes)
-        
-        if len(node_rules.children) == 0:
-            if self.debug: 
-                self.report.write('leaf',False, False, False, xml_nodes)  
-            result = self.return_leaf_content(node_rules, xml_nodes)            
+
+        if len(rule.children) == 0:
+            result = self.return_leaf_content(rule, xml_nodes)
         else:
-            if self.debug: 
-                self.report.write('branch', False, False, False, xml_nodes) 
-            result = self.return_branch_content(node_rules, xml_nodes, xml_parent_node, num)
-        
-        if self.debug: 
-            self.report.write('result before __format__', False, False, False, result)  
-        
-        result = self.mult2single(node_rules, result, num)
-        
-        if self.debug: 
-            self.report.write('result', False, False, False, result)  
+            result = self.return_branch_content(rule, xml_nodes, xml_parent_node, num)
+
+        result = self.mult2single(rule, result, num)
+
+        if self.debug:
+            self.report.write('result', False, False, False, result)
         return result
 
-    def return_leaf_content(self, node_rules, xml_nodes, debug = False):
+    def return_leaf_content(self, rule, xml_nodes, debug = False):
         a = []
         for xml_node in xml_nodes:
-            
-            if node_rules.attr != '':
-                v = self.xml_tree.return_node_attr_value(xml_node, node_rules.attr[1:])
-            elif node_rules.xml:
+
+            if rule.extractor == 'attr':
+                v = self.xml_tree.return_node_attr_value(xml_node, rule.attr_name)
+            elif rule.extractor == 'xml':
                 v = self.xml_tree.return_xml(xml_node)
             else:
                 v = self.xml_tree.return_node_value(xml_node)
-            if self.debug: 
-                self.report.write('v', False, False, False, v)  
             if v == '' or v == None:
-                v = node_rules.default
-                
+                v = rule.default
+
             if v != '':
                 a.append(self._convert_value_(v))
-            
-        a = self.mult2single(node_rules, a)
+
+        a = self.mult2single(rule, a)
         return a
 
-    def return_branch_content(self, node_rules, xml_nodes, xml_parent_node, num, debug = False):
+    def return_branch_content(self, rule, xml_nodes, xml_parent_node, num, debug = False):
         occs = []
         number = 0
         for xml_node in xml_nodes:
             # FIXME pode haver mais de uma instancia d{12}
             occ = {}
             number += 1
-            for child in node_rules.children:
+            for child in rule.children:
                 # ex.: child de aff
-                if self.debug:
-                    self.report.write(node_rules.xpath + '=>' + child.xpath)
                 # child = email
                 # xml_node = node de aff
                 # v = array de email
                 v = self.__convert__(child, xml_node, xml_parent_node, number)
                 if len(v)>0:
-                    if child.to == '' or child.to == '_':
+                    if child.key == '_':
                         occ['_'] = v
+                    elif child.key in occ:
+                        if type(occ[child.key]) != type([]):
+                            occ[child.key] = [occ[child.key]]
+                        occ[child.key].append(v)
                     else:
-                        if child.to in occ.keys():
-                            if type(occ[child.to]) != type([]):
-                                occ[child.to] = [occ[child.to]]
-                            
-                            occ[child.to].append(v)
-                        else:
-                            occ[child.to] = v
+                        occ[child.key] = v
             if occ != {}:
-                occs.append(occ)        
-        
-        return occs  
+                occs.append(occ)
+
+        return occs
 
     def mult2single(self, node_rules, result, num = None):
         r = result
@@ -123,25 +242,25 @@ class XML2JSON:
                 r = result[0]
             elif len(result) == 0:
                 r = ''
-            
+
         #r = self.__control_occ__(node_rules, num, r)
         return r
 
-    
-    
+
+
     def __control_occ__(self, node_rules, num, result):
         key = node_rules.parent.to + '_' +  str(num) + '_' + node_rules.to
-        
+
         if key in self.dict.keys():
             if type(self.dict[key]) != type([]):
                 s = self.dict[key]
                 self.dict[key] = []
                 self.dict[key].append(s)
-                
-            
+
+
             self.dict[key].append(result)
             result = self.dict[key]
-            
+
         else:
             self.dict[key] = result
         return result
@@ -157,4 +276,3 @@ class XML2JSON:
             if isinstance(value, unicode):
                 value = value.encode(enc)
         return value
-
@@ -131,6 +131,7 @@ class PackagesProcessor:
 
                     result = '\n' + '='*80 + '\n' + package.report.result + '\n' + '='*80 + '\n'
                     package.report.write(result, True)
+                    package.report.flush()
                     result += open(package.report.summary_filename, 'r').read()
 
                     open(package.report.summary_filename, 'w').write(result)
@@ -144,6 +145,7 @@ class PackagesProcessor:
                             os.unlink(package.package_path + '/' + f)
                         os.rmdir(package.package_path)
                     self.tracker.register(package.name, 'end-open_package')
+                    self.tracker.flush()
             except Exception as e:
                 self.invalid_packages.append(folder)
                 print('ERROR: package not processed')
@@ -159,6 +161,7 @@ class Package:
         self.package_path = package_path
         self.name = os.path.basename(package_path)
         self.package_sender_email = ''
+        self.logged_files = None
         files = ['detailed.log', 'error.log', 'summarized.txt']
         self.report_files = [report_path + '/' + self.name + '_' + f for f in files]
         log_filename, err_filename, summary_filename = self.report_files
@@ -205,8 +208,12 @@ class Package:
 
         self.report.write('startswith=' + startswith)
         self.report.write('extension=' + extension)
-        self.report.write('files in ' + self.package_path)
-        self.report.write('\n'.join(os.listdir(self.package_path)))
+        # the list of files is written again only if it has changed
+        files = os.listdir(self.package_path)
+        if files != self.logged_files:
+            self.logged_files = files
+            self.report.write('files in ' + self.package_path)
+            self.report.write('\n'.join(files))
 
         if len(startswith)>0 and len(extension)>0:
             filenames = [ filename for filename in os.listdir(self.package_path) if filename_matches(filename, startswith) and filename.endswith(extension) ]
@@ -8,7 +8,7 @@ from reuse.services.email_service.email_service import EmailService, EmailMessag
 from reuse.services.email_service.report_sender_xml_process import ReportSender,ReportSenderConfiguration
 
 from reuse.input_output.configuration import Configuration
-from reuse.input_output.report import Report
+from reuse.input_output.report import Report, use_buffered_writer, WRITER_QUEUE_SIZE
 from reuse.input_output.parameters import Parameters
 from reuse.input_output.tracker import Tracker
 
@@ -82,6 +82,11 @@ if parameters.check_parameters(sys.argv):
         debug_depth = config.parameters['DEBUG_DEPTH']
         display_on_screen = config.parameters['DISPLAY_MESSAGES_ON_SCREEN']
 
+        # REPORTS_WRITER=buffered: the reports are written by a background thread
+        if config.parameter('REPORTS_WRITER') == 'buffered':
+            queue_size = config.parameter('REPORTS_WRITER_QUEUE_SIZE')
+            use_buffered_writer(int(queue_size) if queue_size.isdigit() else WRITER_QUEUE_SIZE)
+
         report_path = config.parameter('REPORT_PATH') + '/' + return_path_based_on_date()
         if not os.path.exists(report_path):
             os.makedirs(report_path)